@@ -1,10 +1,12 @@
 #!/bin/bash
 #
-# prefilter a dataset collection using feature-selection
+# prefilter a dataset collection using mi_filter.py
 
-if [ $# != 2 ]; then
+if [ $# != 2 -a \( $# != 3 -o "$3" != "-i" \) ]; then
     echo "Wrong number of arguments"
-    echo "Usage: $0 TECHTC_DIR THRESHOLD"
+    echo "Usage: $0 TECHTC_DIR THRESHOLD [-i]"
+    echo "Write the data.csv and data.svmlight files of TECHTC_DIR filtered"
+    echo "under TECHTC_DIR_MI_THRESHOLD, or in place with -i"
     exit 1
 fi
 
@@ -12,7 +14,19 @@ TECHTC_DIR=$(readlink -f $1) # get the absolute path, no matter what
 MI_THRESHOLD=$2
 NEW_TECHTC_DIR=${TECHTC_DIR}_MI_$MI_THRESHOLD
 
-set -x
-cp -fr "$TECHTC_DIR" "$NEW_TECHTC_DIR"
+DIRECTORY=$(cd `dirname "$0"` && pwd)
+
+# the data files, each one followed by -o and its filtered copy under
+# NEW_TECHTC_DIR unless -i is given
+ARGS=()
+while IFS= read -r DATA; do
+    ARGS+=("$DATA")
+    if [ "$3" != "-i" ]; then
+        OUTPUT="${NEW_TECHTC_DIR}/${DATA#${TECHTC_DIR}/}"
+        mkdir -p "$(dirname "$OUTPUT")"
+        ARGS+=(-o "$OUTPUT")
+    fi
+done < <(find "$TECHTC_DIR" -type f \( -name "data.csv" -o -name "data.svmlight" \))
 
-find "$NEW_TECHTC_DIR" -name "data.csv" | parallel feature-selection -i {} -o {} -ainc "-T$MI_THRESHOLD" -D 0 -L
+set -x
+"${DIRECTORY}/mi_filter.py" "$MI_THRESHOLD" "${ARGS[@]}"
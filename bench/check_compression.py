@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Check that compression.py reports corrupt compressed input
+
+"""Check that a compressed file read with compression.open_input
+fails when it is truncated: reading it to the end then closing it must
+raise IOError, every time (the decompressor may not have exited yet
+when the reader reaches the end). Stopping before the end of a valid
+file must not raise. Each check is repeated to catch races.
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import open_input
+
+
+def read_all(fileName, how):
+    '''read fileName to the end with read, readline or iteration, then
+    close it. Return the IOError raised if any.'''
+    f = open_input(fileName)
+    try:
+        if how == "read":
+            while f.read(1 << 16):
+                pass
+        elif how == "readline":
+            while f.readline():
+                pass
+        else:
+            for _ in f:
+                pass
+        f.close()
+    except IOError as e:
+        return e
+    return None
+
+
+def main():
+    usage = "Usage: %prog [Options]"
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--runs", type="int", default=100,
+                      help="Number of times each check is repeated. [default: %default]")
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.error("incorrect number of arguments. Use --help to get more information")
+
+    d = tempfile.mkdtemp(prefix = "techtc_check")
+    # silence the messages of the decompressor on the truncated file
+    stderr = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+    try:
+        valid = os.path.join(d, "valid.gz")
+        truncated = os.path.join(d, "truncated.gz")
+        with gzip.open(valid, "wb") as f:
+            for i in range(200000):
+                f.write("line %d %s\n" % (i, "x" * (i % 50)))
+        with open(valid, "rb") as f:
+            data = f.read()
+        with open(truncated, "wb") as f:
+            f.write(data[:len(data) / 2])
+
+        failures = 0
+        for how in ["read", "readline", "iter"]:
+            n = sum(read_all(truncated, how) is None for _ in range(options.runs))
+            print "truncated, %s to the end: %d/%d runs without error" % (how, n, options.runs)
+            failures += n
+            n = sum(read_all(valid, how) is not None for _ in range(options.runs))
+            print "valid, %s to the end: %d/%d runs with an error" % (how, n, options.runs)
+            failures += n
+        n = 0
+        for _ in range(options.runs):
+            f = open_input(valid)
+            f.read(100)
+            try:
+                f.close()
+            except IOError:
+                n += 1
+        print "valid, stopped early: %d/%d runs with an error" % (n, options.runs)
+        failures += n
+    finally:
+        os.dup2(stderr, 2)
+        os.close(stderr)
+        shutil.rmtree(d)
+    if failures:
+        print "FAILED"
+        sys.exit(1)
+    print "OK"
+
+if __name__ == "__main__":
+    main()
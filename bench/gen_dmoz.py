@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Generate synthetic dmoz RDF dump files
+
+"""Generate synthetic structure.rdf.u8 and content.rdf.u8 files laid
+out like the dmoz dump, with topics under Top/Arts and Top/Science (the
+default roots of build-techtc.py) of configurable depth and fan-out,
+symbolic links between the two trees, aliases, and the elements
+removed by strip_dmoz_rdf.py. The links of the topics point to the
+local web server of webserver.py, spread over several loopback
+addresses (127.0.0.1, 127.0.0.2...) so that they look like different
+hosts to build-techtc.py.
+"""
+
+import os
+import random
+from optparse import OptionParser
+
+header = '''<?xml version="1.0" encoding="UTF-8"?>
+<RDF xmlns:r="http://www.w3.org/TR/RDF/" xmlns:d="http://purl.org/dc/elements/1.0/" xmlns="http://dmoz.org/rdf/">
+'''
+
+footer = "</RDF>\n"
+
+# roots of the generated topic trees
+roots = ["Top/Arts", "Top/Science"]
+
+
+def host_url(host, port):
+    '''url of the host number host (starting at 0) of the local web
+    server'''
+    return "http://127.0.0.%d:%d" % (host + 1, port)
+
+
+class Generator:
+    '''write the topics of the structure and content files as the
+    trees are walked'''
+    def __init__(self, structureFile, contentFile, options):
+        self.s = structureFile
+        self.c = contentFile
+        self.o = options
+        self.rand = random.Random(options.seed)
+        self.catid = 1
+        self.n_topics = 0
+        self.n_links = 0
+
+    def topic(self, name, depth, root):
+        o = self.o
+        self.catid += 1
+        self.n_topics += 1
+        kids = ["%s/T%d" % (name, i) for i in range(o.fanout)] \
+            if depth < o.depth else []
+        s = self.s
+        s.write('<Topic r:id="%s">\n' % name)
+        s.write("  <catid>%d</catid>\n" % self.catid)
+        s.write("  <d:Title>%s</d:Title>\n" % name.rpartition("/")[2])
+        s.write("  <lastUpdate>2011-08-25 10:00:00</lastUpdate>\n")
+        s.write('  <editor r:resource="editor%d"/>\n' % self.rand.randint(0, 99))
+        for k in kids:
+            s.write('  <narrow r:resource="%s"/>\n' % k)
+        if kids and self.rand.random() < o.symbolic:
+            # symbolic link to the subtopic of the same path in the
+            # other tree
+            other = roots[1 - roots.index(root)]
+            s.write('  <symbolic r:resource="S:%s%s"/>\n'
+                    % (other, self.rand.choice(kids)[len(root):]))
+        s.write('  <related r:resource="%s"/>\n' % roots[0])
+        s.write("</Topic>\n")
+        if self.rand.random() < o.symbolic:
+            s.write('<Alias r:id="@%s">\n  <d:Title>%s</d:Title>\n'
+                    '  <Target r:resource="%s"/>\n</Alias>\n'
+                    % (name, name.rpartition("/")[2], name))
+        n = self.rand.randint(0, o.links)
+        ls = ["%s/%s/%d" % (host_url(self.rand.randrange(o.hosts), o.port),
+                            name, i) for i in range(n)]
+        self.n_links += n
+        c = self.c
+        c.write('<Topic r:id="%s">\n' % name)
+        c.write("  <catid>%d</catid>\n" % self.catid)
+        c.write("  <d:Title>%s</d:Title>\n" % name.rpartition("/")[2])
+        for l in ls:
+            c.write('  <link r:resource="%s"/>\n' % l)
+        c.write("</Topic>\n")
+        for l in ls:
+            c.write('<ExternalPage about="%s">\n' % l)
+            c.write("  <d:Title>Page %s</d:Title>\n" % l.rpartition("/")[2])
+            c.write("  <d:Description>Description of %s</d:Description>\n" % l)
+            c.write("  <topic>%s</topic>\n" % name)
+            c.write("</ExternalPage>\n")
+        for k in kids:
+            self.topic(k, depth + 1, root)
+
+
+def generate(outputDir, options):
+    '''generate structure.rdf.u8 and content.rdf.u8 in outputDir,
+    return the number of (topics, links)'''
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    with open(os.path.join(outputDir, "structure.rdf.u8"), "w") as s:
+        with open(os.path.join(outputDir, "content.rdf.u8"), "w") as c:
+            s.write(header)
+            c.write(header)
+            s.write('<Topic r:id="Top">\n  <catid>1</catid>\n')
+            for root in roots:
+                s.write('  <narrow r:resource="%s"/>\n' % root)
+            s.write("</Topic>\n")
+            g = Generator(s, c, options)
+            for root in roots:
+                g.topic(root, 0, root)
+            s.write(footer)
+            c.write(footer)
+    return g.n_topics, g.n_links
+
+
+def add_options(parser):
+    '''add the options of the generator to parser'''
+    parser.add_option("-d", "--depth", type="int", default=3,
+                      help="Depth of the topic trees under Top/Arts and Top/Science. [default: %default]")
+    parser.add_option("-f", "--fanout", type="int", default=4,
+                      help="Number of subtopics of each topic above the maximum depth. [default: %default]")
+    parser.add_option("--links", type="int", default=20,
+                      help="Maximum number of links of a topic, the number of links of each topic being drawn uniformly between 0 and it. [default: %default]")
+    parser.add_option("--symbolic", type="float", default=0.1,
+                      help="Probability for a topic to have a symbolic link to the other tree, and an alias. [default: %default]")
+    parser.add_option("--hosts", type="int", default=8,
+                      help="Number of hosts (loopback addresses) the links are spread over. [default: %default]")
+    parser.add_option("--port", type="int", default=8765,
+                      help="Port of the local web server. [default: %default]")
+    parser.add_option("--seed", type="int", default=1,
+                      help="Random seed. [default: %default]")
+
+
+def main():
+    usage = "Usage: %prog [Options]"
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--output-directory", default=".",
+                      help="Directory where to write structure.rdf.u8 and content.rdf.u8. [default: %default]")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.error("incorrect number of arguments. Use --help to get more information")
+
+    n_topics, n_links = generate(options.output_directory, options)
+    print "Generated", n_topics, "topics and", n_links, "links in", options.output_directory
+
+if __name__ == "__main__":
+    main()
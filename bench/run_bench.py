@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+#
+# Benchmark the stages of the building of a techtc collection
+
+"""Benchmark each stage of the building of a techtc collection, fully
+offline: synthetic dmoz files are generated by gen_dmoz.py and the web
+is replaced by the local servers of webserver.py. The stages are
+
+strip      strip_dmoz_rdf.py on the structure and content files
+structure  parsing of the subtopics of all topics (build-techtc.py)
+links      parsing of the links of all topics (build-techtc.py)
+parse      build-techtc.py -P, choice of the topics and their links
+download   build-techtc.py from the result of parse, downloading the
+           links from the local servers, converting and assembling them
+html2text  conversion of generated html pages into text (-H lxml)
+assemble   filling of the techtc documents of topics with the texts
+csv        techtc2CSV.py --collection on datasets of these topics
+
+and the time and throughput of each one is reported, and appended to
+the output file.
+"""
+
+import os
+import sys
+import imp
+import time
+import pickle
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, root_dir)
+
+import gen_dmoz
+import webserver
+
+stages = ["strip", "structure", "links", "parse", "download", "html2text",
+          "assemble", "csv"]
+
+
+def script(name):
+    return os.path.join(root_dir, name)
+
+
+def load_build_techtc():
+    '''import build-techtc.py as a module'''
+    return imp.load_source("build_techtc", script("build-techtc.py"))
+
+
+class Quiet:
+    '''redirect the stdout to /dev/null, the functions of
+    build-techtc.py printing a lot'''
+    def __enter__(self):
+        sys.stdout.flush()
+        self._stdout = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+    def __exit__(self, *args):
+        sys.stdout.flush()
+        os.dup2(self._stdout, 1)
+        os.close(self._stdout)
+
+
+def run(cmd, log):
+    '''run the command cmd (list of arguments), its output going to
+    the file log'''
+    with open(log, "a") as logFile:
+        logFile.write("$ " + " ".join(cmd) + "\n")
+        logFile.flush()
+        subprocess.check_call(cmd, stdout = logFile, stderr = subprocess.STDOUT)
+
+
+def files_size(fileNames):
+    return sum(os.path.getsize(f) for f in fileNames)
+
+
+class Bench:
+    '''run the stages in the working directory, each stage returning
+    (number of items, unit of the items, number of bytes processed)'''
+    def __init__(self, workDir, options):
+        self.w = workDir
+        self.o = options
+        self.log = os.path.join(workDir, "bench.log")
+        self.structureFile = os.path.join(workDir, "structure.rdf.u8")
+        self.contentFile = os.path.join(workDir, "content.rdf.u8")
+        self.stripped = [os.path.join(workDir, "structure_stripped.rdf.u8"),
+                         os.path.join(workDir, "content_stripped.rdf.u8")]
+        self.dump = os.path.join(workDir, "parse.pkl")
+        self.topics = None      # all topics of the content file
+        self.n_pages = 0        # number of pages of html2text
+
+    def strip(self):
+        run([sys.executable, script("strip_dmoz_rdf.py"),
+             self.structureFile, self.contentFile,
+             "-o", self.stripped[0], "-o", self.stripped[1]]
+            + (["-j", str(self.o.jobs)] if self.o.jobs else []), self.log)
+        return 2, "files", files_size([self.structureFile, self.contentFile])
+
+    def _stripped_or_raw(self):
+        if all(os.path.exists(f) for f in self.stripped):
+            return self.stripped
+        return [self.structureFile, self.contentFile]
+
+    def _topics(self):
+        '''all topics of the content file'''
+        if self.topics is None:
+            bt = load_build_techtc()
+            self.topics = []
+            for _, t in bt.etree.iterparse(self._stripped_or_raw()[1],
+                                           tag = bt.ns() + "Topic"):
+                self.topics.append(t.attrib[bt.r() + "id"])
+                t.clear()
+        return self.topics
+
+    def structure(self):
+        bt = load_build_techtc()
+        structureFile = self._stripped_or_raw()[0]
+        topics = self._topics()
+        with Quiet():
+            bt.prefetchSubtopics(structureFile, topics, ("narrow", "symbolic"))
+        return len(topics), "topics", os.path.getsize(structureFile)
+
+    def links(self):
+        bt = load_build_techtc()
+        contentFile = self._stripped_or_raw()[1]
+        topics = self._topics()
+        with Quiet():
+            res = bt.dictLinks(contentFile, topics)
+        return len(res), "topics", os.path.getsize(contentFile)
+
+    def _build_techtc_cmd(self):
+        structureFile, contentFile = self._stripped_or_raw()
+        return [sys.executable, script("build-techtc.py"),
+                "-s", structureFile, "-c", contentFile,
+                "-S", str(self.o.S), "-L", str(self.o.L)]
+
+    def parse(self):
+        run(self._build_techtc_cmd() + ["-P", "-o", self.dump], self.log)
+        with open(self.dump) as f:
+            til = pickle.load(f)
+        return (len(til[0]) + len(til[1]), "topics",
+                files_size(self._stripped_or_raw()))
+
+    def download(self):
+        if not os.path.exists(self.dump):
+            self.parse()
+        outputDir = os.path.join(self.w, "techtc")
+        if os.path.exists(outputDir):
+            shutil.rmtree(outputDir)
+        server = webserver.WebServer(self.o.port, self.o.hosts,
+                                     self.o.latency, self.o.failure_rate,
+                                     self.o.page_size).start()
+        try:
+            run(self._build_techtc_cmd()
+                + ["-i", self.dump, "-O", outputDir, "-H", "lxml"]
+                + self.o.build_options.split(), self.log)
+        finally:
+            server.stop()
+        return server.stats["requests"], "links", server.stats["bytes"]
+
+    def html2text(self):
+        bt = load_build_techtc()
+        d = os.path.join(self.w, "pages")
+        if os.path.exists(d):
+            shutil.rmtree(d)
+        os.makedirs(d)
+        htmlFiles = []
+        for i in range(self.o.pages):
+            htmlFile = os.path.join(d, "doc_%d.html" % i)
+            with open(htmlFile, "w") as f:
+                f.write(webserver.page("/bench/%d" % i, self.o.page_size))
+            htmlFiles.append(htmlFile)
+        start = time.time()
+        for htmlFile in htmlFiles:
+            bt.lxml_html2text(htmlFile, htmlFile[:-len(".html")] + ".txt")
+        self.n_pages = len(htmlFiles)
+        # the generation of the pages is not counted
+        self.elapsed = time.time() - start
+        return len(htmlFiles), "pages", files_size(htmlFiles)
+
+    def assemble(self):
+        bt = load_build_techtc()
+        if not self.n_pages:
+            self.html2text()
+        pages = os.path.join(self.w, "pages")
+
+        class Options:
+            O = os.path.join(self.w, "topics")
+            Q = 100000
+            q = 0.0
+        if os.path.exists(Options.O):
+            shutil.rmtree(Options.O)
+        os.makedirs(Options.O)
+        # the pages are spread over the topics, each text file is
+        # placed in the directory of its topic as build-techtc.py does
+        jobs = []
+        for i in range(self.n_pages):
+            topic_id = str(i % self.o.topics)
+            t_dir = bt.topic_dir(Options, topic_id)
+            if not os.path.exists(t_dir):
+                os.makedirs(t_dir)
+            os.link(os.path.join(pages, "doc_%d.txt" % i),
+                    bt.doc_path_txt(Options, topic_id, i))
+            jobs.append((topic_id, i))
+        start = time.time()
+        with Quiet():
+            for topic_id, i in jobs:
+                bt.fillTechtcFormatDocument(Options, topic_id, i)
+        self.elapsed = time.time() - start
+        return len(jobs), "docs", files_size(
+            [bt.doc_path_txt(Options, t, i) for t, i in jobs])
+
+    def csv(self):
+        topicsDir = os.path.join(self.w, "topics")
+        if not os.path.exists(topicsDir):
+            self.assemble()
+        topics = sorted(os.listdir(topicsDir), key = int)
+        collection = os.path.join(self.w, "collection")
+        if os.path.exists(collection):
+            shutil.rmtree(collection)
+        # pairs of the first half of the topics with the second half
+        half = len(topics) / 2
+        n = 0
+        size = 0
+        for p in topics[:half]:
+            for q in topics[half:]:
+                d = os.path.join(collection, "Exp_%s_%s" % (p, q))
+                os.makedirs(d)
+                for t, name in ((p, "all_pos.txt"), (q, "all_neg.txt")):
+                    src = os.path.join(topicsDir, t, "techtc_doc.txt")
+                    os.link(src, os.path.join(d, name))
+                    size += os.path.getsize(src)
+                n += 1
+        run([sys.executable, script("techtc2CSV.py"), "--collection",
+             collection, "-f", self.o.format]
+            + (["-j", str(self.o.jobs)] if self.o.jobs else []), self.log)
+        return n, "datasets", size
+
+    def run(self, stage):
+        '''run stage, return (seconds, items, unit, bytes)'''
+        self.elapsed = None
+        start = time.time()
+        items, unit, size = getattr(self, stage)()
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - start
+        return elapsed, items, unit, size
+
+
+def report_line(stage, elapsed, items, unit, size):
+    rate = items / elapsed if elapsed else 0
+    mb = size / float(1 << 20)
+    return "%-10s %9.3f %8d %-8s %10.1f %8.1f %8.2f" % (
+        stage, elapsed, items, unit, rate, mb, mb / elapsed if elapsed else 0)
+
+
+def main():
+    usage = "Usage: %prog [Options]"
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--stages", default=",".join(stages),
+                      help="Comma separated list of the stages to run, among " + ", ".join(stages) + ". [default: all]")
+    parser.add_option("-w", "--work-directory",
+                      help="Directory where to generate the files, kept after the benchmark. By default a temporary directory is used and removed.")
+    parser.add_option("-o", "--output-file",
+                      default=os.path.join(root_dir, "bench_output.txt"),
+                      help="File where to append the results. [default: %default]")
+    parser.add_option("-S", type="int", default=10,
+                      help="Size of the techtc collection built by parse and download (option -S of build-techtc.py). [default: %default]")
+    parser.add_option("-L", type="int", default=10,
+                      help="Maximum number of documents per topic (option -L of build-techtc.py). [default: %default]")
+    parser.add_option("-j", "--jobs", type="int",
+                      help="Number of processes of strip and csv (option -j of strip_dmoz_rdf.py and techtc2CSV.py). [default: number of CPUs]")
+    parser.add_option("-b", "--build-options", default="",
+                      help="Additional options of build-techtc.py for the download stage, like \"-j 16 --host-jobs 2\".")
+    parser.add_option("--pages", type="int", default=500,
+                      help="Number of pages of html2text and assemble. [default: %default]")
+    parser.add_option("--topics", type="int", default=20,
+                      help="Number of topics the pages are spread over by assemble, csv converts the datasets of all pairs of the first half of them and the second half. [default: %default]")
+    parser.add_option("--format", default="csv",
+                      help="Output format of csv (option -f of techtc2CSV.py). [default: %default]")
+    gen_dmoz.add_options(parser)
+    webserver.add_options(parser)
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.error("incorrect number of arguments. Use --help to get more information")
+    selected = options.stages.split(",")
+    for stage in selected:
+        if stage not in stages:
+            parser.error("unknown stage " + stage)
+
+    workDir = options.work_directory or tempfile.mkdtemp(prefix = "techtc_bench")
+    try:
+        n_topics, n_links = gen_dmoz.generate(workDir, options)
+        bench = Bench(workDir, options)
+        header = "%-10s %9s %8s %-8s %10s %8s %8s" % (
+            "stage", "seconds", "items", "unit", "items/s", "MB", "MB/s")
+        lines = ["# %s, %d topics, %d links, %s" % (
+            time.strftime("%Y-%m-%d %H:%M:%S"), n_topics, n_links,
+            " ".join(sys.argv[1:])), header]
+        print lines[0]
+        print header
+        for stage in stages:
+            if stage in selected:
+                lines.append(report_line(stage, *bench.run(stage)))
+                print lines[-1]
+                sys.stdout.flush()
+        with open(options.output_file, "a") as outputFile:
+            outputFile.write("\n".join(lines) + "\n\n")
+    finally:
+        if not options.work_directory:
+            shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    main()
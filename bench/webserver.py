@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the web, serving generated html pages
+
+"""Serve generated html pages on several loopback addresses
+(127.0.0.1, 127.0.0.2...), one per host of the links generated by
+gen_dmoz.py. The page of a path is always the same (it is generated
+from a hash of the path). Each response is delayed by a random latency,
+and a proportion of the paths fail, with a 404, a 500 or a connection
+closed without response.
+"""
+
+import time
+import random
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+# words of the generated pages
+vocabulary = None
+
+
+def words(rand, n):
+    global vocabulary
+    if vocabulary is None:
+        r = random.Random(0)
+        vocabulary = ["".join(r.choice("abcdefghijklmnopqrstuvwxyz")
+                              for _ in range(r.randint(2, 10)))
+                      for _ in range(5000)]
+    # a few words are much more frequent than the others, like in text
+    return " ".join(vocabulary[int((rand.paretovariate(1.0) - 1) * 50) % len(vocabulary)]
+                    for _ in range(n))
+
+
+def page(path, size):
+    '''html page of about size bytes for path'''
+    rand = random.Random(hashlib.md5(path).hexdigest())
+    parts = ["<html><head><title>%s</title>" % path,
+             "<script>var path = '%s';</script>" % path,
+             "<style>p { margin: 0 }</style></head><body>",
+             "<h1>%s</h1>" % words(rand, 4)]
+    n = 0
+    while n < size:
+        if rand.random() < 0.2:
+            p = "<ul>%s</ul>" % "".join("<li>%s</li>" % words(rand, 5)
+                                         for _ in range(rand.randint(2, 6)))
+        else:
+            p = "<p>%s <b>%s</b> %s.</p>" % (words(rand, 30), words(rand, 2),
+                                             words(rand, 20))
+        parts.append(p)
+        n += len(p)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def failure(path, rate):
+    '''how the request of path fails, None if it doesn't'''
+    h = int(hashlib.md5("failure" + path).hexdigest()[:8], 16)
+    if h < rate * 0xffffffff:
+        return ["404", "500", "close"][h % 3]
+    return None
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        s = self.server
+        s.count("requests")
+        if s.latency:
+            time.sleep(random.uniform(0, 2 * s.latency))
+        f = failure(self.path, s.failure_rate)
+        if f == "close":
+            s.count("failures")
+            self.close_connection = 1
+            return
+        if f:
+            s.count("failures")
+            self.send_response(int(f))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = page(self.path, s.size)
+        s.count("bytes", len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass                    # clients closing the connection early
+
+
+class WebServer:
+    '''web servers of all hosts, running in background threads'''
+    def __init__(self, port, hosts, latency = 0.0, failure_rate = 0.0,
+                 size = 20000):
+        self.stats = {"requests": 0, "failures": 0, "bytes": 0}
+        self._lock = threading.Lock()
+        self._servers = []
+        for h in range(hosts):
+            server = Server(("127.0.0.%d" % (h + 1), port), Handler)
+            server.latency = latency
+            server.failure_rate = failure_rate
+            server.size = size
+            server.count = self.count
+            self._servers.append(server)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.stats[name] += n
+
+    def start(self):
+        for server in self._servers:
+            t = threading.Thread(target = server.serve_forever)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+
+def add_options(parser):
+    '''add the options of the web server to parser'''
+    parser.add_option("--latency", type="float", default=0.05,
+                      help="Mean latency of the responses in seconds, drawn uniformly between 0 and twice it. [default: %default]")
+    parser.add_option("--failure-rate", type="float", default=0.1,
+                      help="Proportion of the paths failing (404, 500 or connection closed). [default: %default]")
+    parser.add_option("--page-size", type="int", default=20000,
+                      help="Approximate size of the pages in bytes. [default: %default]")
+
+
+def main():
+    usage = "Usage: %prog [Options]"
+    parser = OptionParser(usage)
+    parser.add_option("--hosts", type="int", default=8,
+                      help="Number of hosts, served on 127.0.0.1 to 127.0.0.HOSTS. [default: %default]")
+    parser.add_option("--port", type="int", default=8765,
+                      help="Port of the servers. [default: %default]")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.error("incorrect number of arguments. Use --help to get more information")
+
+    server = WebServer(options.port, options.hosts, options.latency,
+                       options.failure_rate, options.page_size).start()
+    print "Serving on 127.0.0.1 to 127.0.0.%d, port %d" % (options.hosts, options.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
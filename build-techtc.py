@@ -2,32 +2,89 @@
 import os
 import sys
 import pickle
-from random import seed, random, choice
-from lxml import etree
+import sqlite3
+import hashlib
+import json
+import errno
+import shutil
+import time
+import threading
+import textwrap
+import subprocess
+import multiprocessing
+from urlparse import urlparse, urlunparse
+from collections import OrderedDict
+from itertools import chain
+import heapq
+from math import log
+from random import seed, random, sample
+from lxml import etree, html
 from optparse import OptionParser
+from compression import open_input
+from fetcher import HTTPFetcher, FetchError
+import metrics
 
-# maximum cache size
+# maximum cache size (number of entries and bytes), can be changed
+# with options --cache-entries and --cache-memory
 cache_size = sys.maxint
+cache_bytes = sys.maxint
+
+def sizeof(x):
+    '''approximate memory usage of x in bytes, including the elements
+    of x if it is a list, tuple or set.'''
+    s = sys.getsizeof(x)
+    if isinstance(x, (list, tuple, set, frozenset)):
+        s += sum(sizeof(e) for e in x)
+    return s
 
 class Cache:
-    '''Simple cache without replacement. f is the function to cache. s
-    is the size of the cache'''
-    def __init__(self, f, s):
+    '''LRU cache. f is the function to cache. s is the maximum number
+    of entries and b the maximum memory usage in bytes of the cache,
+    when one of them is exceeded the least recently used entries are
+    evicted.'''
+    def __init__(self, f, s, b = cache_bytes):
         self._f = f
-        self._d = {}
+        self._d = OrderedDict()
         self._s = s
+        self._b = b
+        self._bytes = 0
         self._calls = 0
         self._failures = 0
+        self._evictions = 0
 
     def __call__(self, x):
         self._calls += 1
         if x not in self._d:
             y = self._f(*x)
-            if len(self._d) < self._s:
-                self._d[x] = y
+            self.insert(x, y)
             self._failures += 1
             return y
-        return self._d[x]
+        y = self._d.pop(x)
+        self._d[x] = y          # move it to the most recently used end
+        return y
+
+    def __contains__(self, x):
+        return x in self._d
+
+    def insert(self, x, y):
+        '''insert the result y of f(*x) computed elsewhere'''
+        if x in self._d:
+            self._bytes -= sizeof(x) + sizeof(self._d.pop(x))
+        self._d[x] = y
+        self._bytes += sizeof(x) + sizeof(y)
+        self._evict()
+
+    def resize(self, s, b):
+        '''change the maximum number of entries and bytes'''
+        self._s = s
+        self._b = b
+        self._evict()
+
+    def _evict(self):
+        while self._d and (len(self._d) > self._s or self._bytes > self._b):
+            x, y = self._d.popitem(last = False)
+            self._bytes -= sizeof(x) + sizeof(y)
+            self._evictions += 1
 
     def get_failures(self):
         return self._failures
@@ -38,6 +95,23 @@ class Cache:
     def get_hits(self):
         return self._calls - self._failures
 
+    def get_evictions(self):
+        return self._evictions
+
+    def get_size(self):
+        return len(self._d)
+
+    def get_bytes(self):
+        return self._bytes
+
+    def stats(self):
+        return {"calls": self.get_calls(),
+                "hits": self.get_hits(),
+                "failures": self.get_failures(),
+                "evictions": self.get_evictions(),
+                "entries": self.get_size(),
+                "bytes": self.get_bytes()}
+
 
 def ns():
     '''contain the namespace of dmoz xml file (kinda hacky)'''
@@ -48,31 +122,160 @@ def r():
     return "{http://www.w3.org/TR/RDF/}"
 
 
+def closeRDF(f):
+    '''close the RDF file f, counting the bytes parsed'''
+    metrics.count("rdf_bytes", f.tell())
+    metrics.count("rdf_passes")
+    f.close()
+
+
+# map contentFileName to the sqlite connection of its index, filled
+# by loadContentIndex (option -I)
+content_indexes = {}
+
+def content_index_path(contentFileName):
+    return contentFileName + ".idx"
+
+def fileSignature(fileName):
+    '''return a string identifying the current version of fileName,
+    based on its size, modification time and a hash of its first and
+    last MB.'''
+    st = os.stat(fileName)
+    h = hashlib.sha1()
+    with open(fileName, "rb") as f:
+        h.update(f.read(1 << 20))
+        if st.st_size > 1 << 20:
+            f.seek(max(1 << 20, st.st_size - (1 << 20)))
+            h.update(f.read())
+    return "%d:%d:%s" % (st.st_size, int(st.st_mtime), h.hexdigest())
+
+def buildContentIndex(contentFileName, indexFileName):
+    '''parse the content file once and write an index mapping each
+    topic to its catid and its links in sqlite file indexFileName.'''
+    if os.path.exists(indexFileName):
+        os.remove(indexFileName)
+    tmpFileName = indexFileName + ".tmp"
+    if os.path.exists(tmpFileName):
+        os.remove(tmpFileName)
+    db = sqlite3.connect(tmpFileName)
+    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("CREATE TABLE topics (topic TEXT PRIMARY KEY, catid TEXT, links TEXT)")
+    cf = open_input(contentFileName)
+    i = 0
+    for _,t in etree.iterparse(cf, tag = ns()+"Topic"):
+        l = [n.attrib[r()+"resource"] for n in t.iter() if "link" in n.tag]
+        # like links, keep the first topic in case of duplicates
+        db.execute("INSERT OR IGNORE INTO topics VALUES (?, ?, ?)",
+                   (t.attrib[r()+"id"], t.findtext(ns()+"catid"),
+                    "\n".join(l)))
+        t.clear()
+        while t.getprevious() is not None:
+            del t.getparent()[0]
+        i += 1
+        if i % 100000 == 0:
+            print i, "topics indexed"
+    closeRDF(cf)
+    db.execute("INSERT INTO meta VALUES ('signature', ?)",
+               (fileSignature(contentFileName),))
+    db.commit()
+    db.close()
+    os.rename(tmpFileName, indexFileName)
+    print i, "topics indexed in", indexFileName
+
+def loadContentIndex(contentFileName):
+    '''open the index of contentFileName, (re)building it first if it
+    doesn't exist or if the content file has changed since.'''
+    indexFileName = content_index_path(contentFileName)
+    signature = None
+    if os.path.exists(indexFileName):
+        db = sqlite3.connect(indexFileName)
+        try:
+            signature = db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        except sqlite3.DatabaseError:
+            pass
+        db.close()
+    if signature is None or signature[0] != fileSignature(contentFileName):
+        print "Build index", indexFileName, "of", contentFileName
+        buildContentIndex(contentFileName, indexFileName)
+    db = sqlite3.connect(indexFileName, check_same_thread = False)
+    content_indexes[contentFileName] = db
+    return db
+
+def indexedTopics(contentFileName, topics):
+    '''return the list of (topic, catid, links) of topics present in
+    the index, in the order of the content file.'''
+    db = content_indexes[contentFileName]
+    res = []
+    topics = list(topics)
+    for i in range(0, len(topics), 500): # stay under the sqlite limit
+        chunk = topics[i:i+500]
+        query = "SELECT rowid, topic, catid, links FROM topics WHERE topic IN (" + ",".join("?" * len(chunk)) + ")"
+        res += db.execute(query, chunk).fetchall()
+    res.sort()
+    return [(t, c, l.split("\n") if l else []) for _, t, c, l in res]
+
 def links(contentFileName, cat):
     '''return the list of links of category cat.'''
-    cf = open(contentFileName)
+    db = content_indexes.get(contentFileName)
+    if db is not None:
+        row = db.execute("SELECT links FROM topics WHERE topic = ?",
+                         (cat,)).fetchone()
+        if row:
+            return row[0].split("\n") if row[0] else []
+        print cat,"Not found!"
+        return []
+    cf = open_input(contentFileName)
     for _,t in etree.iterparse(cf, tag = ns()+"Topic"):
         # print "t.attrib[r()+\"id\"] =", t.attrib[r()+"id"]
         if cat == t.attrib[r()+"id"]:
             l = [n.attrib[r()+"resource"] for n in t.iter() if "link" in n.tag]
             t.clear()
+            closeRDF(cf)
             return l
         t.clear()
-    cf.close()
+    closeRDF(cf)
     print cat,"Not found!"
     return []
 
 clinks = Cache(links, cache_size)
 
-def choiceLinks(contentFileName, cat):
-    '''Choose randomly a link belonging to cat. If no link exists it
-    returns None'''
-    l = clinks((contentFileName, cat))
-    if l:
-        return choice(l)
-    else:
-        return None
+def dictLinks(contentFileName, cats):
+    '''return the list of (topic, catid, links) of all categories
+    cats present in the content file, in the order of the content
+    file. The content file is parsed only once for all of them.'''
+    if contentFileName in content_indexes:
+        return indexedTopics(contentFileName, cats)
+    cats = set(cats)
+    res = []
+    if not cats:
+        return res
+    found = set()
+    cf = open_input(contentFileName)
+    for _,t in etree.iterparse(cf, tag = ns()+"Topic"):
+        topic = t.attrib[r()+"id"]
+        if topic in cats and topic not in found:
+            found.add(topic)
+            l = [n.attrib[r()+"resource"] for n in t.iter() if "link" in n.tag]
+            res.append((topic, t.findtext(ns()+"catid"), l))
+        t.clear()
+        while t.getprevious() is not None:
+            del t.getparent()[0]
+        if len(found) == len(cats): # no need to parse further
+            break
+    closeRDF(cf)
+    return res
 
+def prefetchLinks(contentFileName, cats):
+    '''make sure the links of all categories cats are in clinks,
+    parsing the content file at most once.'''
+    cats = set(cat for cat in cats if (contentFileName, cat) not in clinks)
+    found = set()
+    for topic, _, l in dictLinks(contentFileName, cats):
+        clinks.insert((contentFileName, topic), l)
+        found.add(topic)
+    for cat in cats - found:
+        print cat,"Not found!"
+        clinks.insert((contentFileName, cat), [])
 
 def collectLinks(contentFileName, cats, n = None):
     '''given a set of categories collect a maximum of n links over the
@@ -91,44 +294,32 @@ def printLinks(ls):
         i += 1
         print i, l
 
-def collectLinksBFS(cat, options):
-    '''collects up to n links in BFS order from category cat.'''
-    cats = [cat]
-    l = []
-    s = len(l)
-    n = options.L
-    while s < n and len(cats) > 0:
-        l += collectLinks(options.c, cats, n - s)
-        s = len(l)
-        if s < n:
-            cats = sum([csubtopics((options.s, cat,
-                                    tuple(options.subtopic_tags)))
-                        for cat in cats], [])
-        else:
-            printLinks(l[:n])
-            return l[:n]
-    printLinks(l)
-    return l
-
-
-def choiceCollectLinks(cat, options, m = -1):
-    '''randomly choose a set of links belonging to a category (or its
-    subtopics). If after m attempts the number of links n hasn't
-    been reached (considering that duplicated links are ignored) then
-    it returns the empty set. If m is negative then there is no limit
-    in the number of attempts (which can lead to infinit loop). p is
-    the probability to dig deeper in the hierarchy to get the links.'''
-    res = set()
+def collectLinksBFSBatch(cats, options):
+    '''collect up to options.L links in BFS order from each category
+    of cats, the links of a category first, then those of its
+    subtopics, and so on. The BFS is performed level by level for all
+    of them at once, so that the content file (and the structure file,
+    unless it is loaded in memory) is parsed only once per depth.
+    Return a dict mapping each category of cats to its links.'''
+    tags = tuple(options.subtopic_tags)
     n = options.L
-    while len(res) < n and m != 0:
-        scat = choiceCategory(cat, options)
-        if scat:
-            link = choiceLinks(options.c, scat)
-            if link:
-                if link not in res:
-                    res.add(link)
-                    print len(res), link
-        m -= 1
+    res = dict((cat, []) for cat in cats)
+    frontiers = dict((cat, [cat]) for cat in cats)
+    while frontiers:
+        prefetchLinks(options.c, chain.from_iterable(frontiers.values()))
+        for cat, scats in frontiers.items():
+            res[cat] += collectLinks(options.c, scats, n - len(res[cat]))
+            if len(res[cat]) >= n:
+                del frontiers[cat]
+        prefetchSubtopics(options.s, chain.from_iterable(frontiers.values()),
+                          tags)
+        for cat, scats in frontiers.items():
+            scats = sum([csubtopics((options.s, scat, tags))
+                         for scat in scats], [])
+            if scats:
+                frontiers[cat] = scats
+            else:
+                del frontiers[cat]
     return res
 
 
@@ -137,59 +328,220 @@ def rmSym(topic):
     topic has been obtained from a symbolic link'''
     return topic.partition(':')[2] if ':' in topic else topic
 
+# map (structureFileName, subtopic_tags) to a dict topic -> direct
+# subtopics, filled by loadStructure (option -T)
+structure_trees = {}
+
+def loadStructure(structureFileName, subtopic_tags):
+    '''parse the structure file once and keep in memory the mapping
+    between each topic and its direct subtopics. Then subtopics no
+    longer needs to parse the structure file.'''
+    tree = {}
+    sf = open_input(structureFileName)
+    for _,t in etree.iterparse(sf, tag = ns()+"Topic"):
+        topic = t.attrib[r()+"id"]
+        if topic not in tree:   # like subtopics, keep the first one
+            tree[topic] = [rmSym(n.attrib[r()+"resource"]) for n in t.iter()
+                           if any((st in n.tag) for st in subtopic_tags)]
+        t.clear()
+        # free the topics already parsed
+        while t.getprevious() is not None:
+            del t.getparent()[0]
+    closeRDF(sf)
+    structure_trees[(structureFileName, subtopic_tags)] = tree
+    return tree
+
 def subtopics(structureFileName, cat, subtopic_tags):
     '''return the list of direct subtopics of cat. If there isn't
     such cat then it returns the empty list.'''
-    sf = open(structureFileName)
+    tree = structure_trees.get((structureFileName, subtopic_tags))
+    if tree is not None:
+        return tree.get(cat, [])
+    sf = open_input(structureFileName)
     for _,t in etree.iterparse(sf, tag = ns()+"Topic"):
         if cat == t.attrib[r()+"id"]:
             l = [rmSym(n.attrib[r()+"resource"]) for n in t.iter()
                  if any((st in n.tag) for st in subtopic_tags)]
             t.clear()
+            closeRDF(sf)
             return l
         t.clear()
-    sf.close()
+    closeRDF(sf)
     return []
 
 csubtopics = Cache(subtopics, cache_size)
 
-def choiceSubtopic(cat, options):
-    '''given a category choose randomly a subcategory from it. p is
-    the probability to choose a subcategory which is not a direct
-    child of cat. struct_root is the root element of the
-    structure.rdf.u8 file.'''
-    
-    l = csubtopics((options.s, cat, tuple(options.subtopic_tags)))
+def prefetchSubtopics(structureFileName, cats, subtopic_tags):
+    '''make sure the subtopics of all categories cats are in
+    csubtopics, parsing the structure file at most once.'''
+    if (structureFileName, subtopic_tags) in structure_trees:
+        return
+    cats = set(cat for cat in cats
+               if (structureFileName, cat, subtopic_tags) not in csubtopics)
+    if not cats:
+        return
+    sf = open_input(structureFileName)
+    for _,t in etree.iterparse(sf, tag = ns()+"Topic"):
+        cat = t.attrib[r()+"id"]
+        if cat in cats:
+            cats.remove(cat)
+            csubtopics.insert((structureFileName, cat, subtopic_tags),
+                              [rmSym(n.attrib[r()+"resource"]) for n in t.iter()
+                               if any((st in n.tag) for st in subtopic_tags)])
+        t.clear()
+        while t.getprevious() is not None:
+            del t.getparent()[0]
+        if not cats:            # no need to parse further
+            break
+    closeRDF(sf)
+    for cat in cats:
+        csubtopics.insert((structureFileName, cat, subtopic_tags), [])
+
+
+# below that probability a category is not explored further by
+# walkMass
+walk_min_mass = 1e-9
+
+def walkMass(cat, options, include_self = True):
+    '''return a dict mapping each category to the probability that a
+    random walk down from cat stops at it. The walk stops at cat with
+    probability 1 - options.rp (never if include_self is False),
+    otherwise it moves to a subtopic chosen uniformly, where it stops
+    with probability 1 - options.rp or moves on the same way, a
+    subtopic without subtopics stopping it. The probabilities are
+    propagated level by level, so the structure file is parsed at
+    most once per level. The probability lost because cat has no
+    subtopic is not included, and the categories reached with a
+    probability under walk_min_mass are not explored further (as if
+    they had no subtopic).'''
+    tags = tuple(options.subtopic_tags)
     p = options.rp
-    if l:
-        sc = choice(l)
-        if random() <= p:
-            scr = choiceSubtopic(sc, options)
-            if scr:
-                sc = scr
-        return sc
+    mass = {}
+    if include_self:
+        mass[cat] = 1 - p
+        frontier = {cat: p}
     else:
-        return None
-
+        frontier = {cat: 1.0}
+    root = True                 # cat itself may have no subtopic
+    while frontier:
+        prefetchSubtopics(options.s, frontier.keys(), tags)
+        nxt = {}
+        for c, m in frontier.iteritems():
+            l = csubtopics((options.s, c, tags))
+            if not l:
+                # a subtopic without subtopics is chosen itself
+                if not root:
+                    mass[c] = mass.get(c, 0) + m
+                continue
+            m /= len(l)
+            for sc in l:
+                mass[sc] = mass.get(sc, 0) + m * (1 - p)
+                nxt[sc] = nxt.get(sc, 0) + m * p
+        frontier = {}
+        for c, m in nxt.iteritems():
+            if m < walk_min_mass:
+                mass[c] += m
+            else:
+                frontier[c] = m
+        root = False
+    return mass
+
+
+def sampleLinks(mass, options):
+    '''randomly choose up to options.L distinct links belonging to the
+    categories of mass, a dict mapping categories to their
+    probabilities as returned by walkMass. Each link is chosen with
+    the probability of its category divided by the number of links of
+    the category, without replacement (Efraimidis-Spirakis sampling).'''
+    prefetchLinks(options.c, mass.keys())
+    weights = {}
+    for c, m in mass.iteritems():
+        l = clinks((options.c, c))
+        for link in l:
+            weights[link] = weights.get(link, 0) + m / len(l)
+    res = weightedSample(weights, options.L)
+    printLinks(res)
+    return res
 
-def choiceCategory(cat, options):
-    '''like ChoiceSubtopic but consider cat as a result too'''
-    p = options.rp
-    if random() <= p:
-        return choiceSubtopic(cat, options)
-    else:
-        return cat
 
+def weightedSample(weights, k):
+    '''randomly choose up to k distinct keys of weights, a dict
+    mapping keys to their weights, each draw choosing a key not chosen
+    yet with a probability proportional to its weight
+    (Efraimidis-Spirakis sampling). The keys are returned in the order
+    of the draws.'''
+    keys = [(log(1 - random()) / w, x)
+            for x, w in sorted(weights.iteritems()) if w > 0]
+    return [x for _, x in heapq.nlargest(k, keys)]
+
+
+def error(msg):
+    '''print error message msg and exit'''
+    sys.stderr.write("error: " + msg + os.linesep)
+    sys.exit(1)
+
+
+def choiceSubtopics(rootTopic, topics, til, options, side = None):
+    '''Given an initial set of topics, return a set of options.S
+    topics, those of the initial set with at least options.l *
+    options.L links and new subtopics of rootTopic randomly chosen.
+    The ids and links of the topics are inserted in til as they are
+    chosen, by batches, so that the subtopics without enough links
+    are replaced by others before anything is downloaded. side (pos
+    or neg) is used to record them in the journal. The new subtopics
+    are drawn without replacement with the probabilities of the
+    random walk of walkMass (never stopping at rootTopic), so each one
+    is chosen like by repeating the walk until a new subtopic with
+    enough links comes up.'''
 
-def choiceSubtopics(rootTopic, topics, options):
-    '''Given an initial set of topics, a insert new subtopics of
-    rootTopic randomly chosen'''
-    
-    while len(topics) < options.S:
-        t = choiceSubtopic(rootTopic, options)
-        if t not in topics:
-            topics.add(t)
-            print len(topics),t
+    minl = int(options.l * options.L)
+    enough = lambda t: t in til and len(getLinks(til[t])) >= minl
+    with metrics.stage("links"):
+        dictTopicIdLinks(topics, til, options, side)
+    chosen = set(t for t in topics if enough(t))
+    n = options.S - len(chosen)
+    if n <= 0:
+        return chosen
+    with metrics.stage("subtopics"):
+        mass = walkMass(rootTopic, options, False)
+    weights = dict((t, m) for t, m in mass.iteritems() if t not in topics)
+    if len(weights) < n:
+        error("cannot choose " + str(options.S) + " subtopics of "
+              + rootTopic + ", only " + str(len(weights) + len(chosen))
+              + " can be reached")
+    # the order in which all the subtopics are drawn, the first ones
+    # with enough links are chosen
+    order = weightedSample(weights, len(weights))
+    i = 0
+    accepted = 0
+    while n > 0 and i < len(order):
+        # enough subtopics for the remaining ones, according to the
+        # proportion of the subtopics with enough links so far
+        if accepted:
+            size = (n * i + accepted - 1) / accepted
+        else:
+            size = 2 * i or n
+        batch = order[i:i + size]
+        i += len(batch)
+        with metrics.stage("links"):
+            dictTopicIdLinks(batch, til, options, side)
+            for t in batch:
+                if not n:
+                    break
+                if enough(t):
+                    chosen.add(t)
+                    n -= 1
+                    accepted += 1
+                    print len(chosen),t
+                    if journal:
+                        journal.subtopic(side, t)
+                else:
+                    metrics.count("topics_rejected")
+    if n:
+        error("cannot choose " + str(options.S) + " subtopics of "
+              + rootTopic + ", only " + str(len(chosen)) + " have at least "
+              + str(minl) + " links")
+    return chosen
 
 
 def choiceSubtopicsPairs(til, options):
@@ -197,14 +549,30 @@ def choiceSubtopicsPairs(til, options):
     = (ptil, ntil)'''
 
     spl = set()
-    pk = til[0].keys()
-    nk = til[1].keys()
-    while len(spl) < options.S:
-        assert til[0] and til[1]
-        p = (choice(pk), choice(nk))
+    if journal:                 # pairs chosen by the interrupted run
+        spl.update(p for p in journal.pairs
+                   if p[0] in til[0] and p[1] in til[1])
+    n = options.S - len(spl)
+    if n <= 0:
+        return spl
+    pk = sorted(til[0])
+    nk = sorted(til[1])
+    # the pairs are drawn as indexes of the product pk x nk, enough of
+    # them so that n are not already chosen
+    if len(pk) * len(nk) - len(spl) < n:
+        error("cannot build " + str(options.S) + " pairs out of "
+              + str(len(pk)) + " positive and " + str(len(nk))
+              + " negative topics")
+    for k in sample(xrange(len(pk) * len(nk)), n + len(spl)):
+        p = (pk[k / len(nk)], nk[k % len(nk)])
         if p not in spl:
             spl.add(p)
             print len(spl),p
+            if journal:
+                journal.pair(p)
+            n -= 1
+            if n == 0:
+                break
     return spl
 
 
@@ -237,13 +605,12 @@ def wget_cmd(topic_id, doc_index, link, options):
     # addresses
     cmd += " \"" + ASCII_strip(link) + "\""
     cmd += " -O \"" + doc_path_html(options, topic_id, doc_index) + "\""
-    # TODO add program options for these parameters
     cmd += " -t 1"              # try only once
     cmd += " --random-wait"
-    cmd += " --timeout=3"       # wait 3 sec max
+    cmd += " --timeout=%g" % options.timeout
     cmd += " -q"
-    # TODO this command doesn't do the right thing (wait no more than 30 sec)
-    # cmd += " & sleep 30 && kill ${!}"
+    # there is no limit on the overall time of wget, use -F http to
+    # have one (option --deadline)
     return cmd
 
 
@@ -251,6 +618,192 @@ def html2text_cmd(topic_id, doc_index, options):
     return globals()[options.H+"_cmd"](topic_id, doc_index, options)
 
 
+# commands of the softwares of option -H converting the html given on
+# their stdin
+html2text_stdin_cmds = {"w3m": ["w3m", "-T", "text/html", "-dump"],
+                        "lynx": ["lynx", "-force_html", "-dump", "-stdin"]}
+
+# pool of processes running lxml_html2text, created by downloadJobs
+html2text_pool = None
+
+def html2text(topic_id, doc_index, options, data = None):
+    '''convert the html of a document into text, with the software
+    given by option -H. The html is data if given (fetched by -F
+    http), otherwise it is read from the html file of the document.'''
+    dpt = doc_path_txt(options, topic_id, doc_index)
+    if options.H == "lxml":
+        if data is None:
+            f, args = lxml_html2text, (doc_path_html(options, topic_id, doc_index), dpt)
+        else:
+            f, args = lxml_data2text, (data, dpt)
+        print "Convert", doc_path(options, topic_id, doc_index), "into text"
+        if html2text_pool:
+            html2text_pool.apply(f, args)
+        else:
+            f(*args)
+    elif data is not None and options.H in html2text_stdin_cmds:
+        cmd = html2text_stdin_cmds[options.H]
+        print " ".join(cmd), ">", dpt
+        with open(dpt, "wb") as textFile:
+            p = subprocess.Popen(cmd, stdin = subprocess.PIPE,
+                                 stdout = textFile)
+            p.communicate(data)
+    else:
+        if data is not None:
+            with open(doc_path_html(options, topic_id, doc_index), "wb") as f:
+                f.write(data)
+        cmd = html2text_cmd(topic_id, doc_index, options)
+        print cmd
+        os.system(cmd)
+
+
+# tags whose content is not displayed by lxml_html2text
+html_ignored_tags = set(["head", "title", "script", "style", "noscript",
+                         "iframe", "object", "applet", "embed", "select",
+                         "textarea", "map", "frameset"])
+# tags separated from the rest of the text by an empty line
+html_paragraph_tags = set(["p", "h1", "h2", "h3", "h4", "h5", "h6", "ul",
+                           "ol", "dl", "table", "pre", "blockquote",
+                           "form", "hr", "address", "center", "menu",
+                           "dir", "fieldset"])
+# tags starting on a new line
+html_block_tags = set(["div", "li", "dt", "dd", "tr", "caption", "section",
+                       "article", "aside", "header", "footer", "nav",
+                       "main", "figure", "figcaption", "noframes", "body",
+                       "option", "legend"])
+
+class TextDump:
+    '''accumulate the text of a html document formatted like w3m
+    -dump does, that is paragraphs wrapped at width columns, list
+    items starting with a bullet and preformatted text left as it
+    is.'''
+    def __init__(self, width = 80):
+        self._width = width
+        self._lines = []
+        self._text = []         # text of the current line, as it comes
+        self._prefix = ""
+        self._indent = ""
+        self._blank = True     # whether the last line is blank
+
+    def text(self, s):
+        '''add s, its spaces are collapsed only by newline so that
+        inline tags don't split words'''
+        if s:
+            self._text.append(s)
+
+    def separate(self):
+        '''separate the text before from the text after, like table
+        cells'''
+        self._text.append(" ")
+
+    def newline(self):
+        words = "".join(self._text).split()
+        if words:
+            self._lines += textwrap.wrap(" ".join(words), self._width,
+                                         initial_indent = self._prefix,
+                                         subsequent_indent = self._indent,
+                                         break_on_hyphens = False) or [""]
+            self._blank = False
+        self._text = []
+        self._prefix = self._indent
+
+    def paragraph(self):
+        self.newline()
+        if not self._blank:
+            self._lines.append("")
+            self._blank = True
+
+    def item(self, depth, bullet):
+        self.newline()
+        self._prefix = "  " * depth + bullet + " "
+        self._indent = " " * len(self._prefix)
+
+    def unindent(self, depth):
+        self.newline()
+        self._prefix = self._indent = "  " * depth
+
+    def preformatted(self, s):
+        self.paragraph()
+        self._lines += s.strip("\n").expandtabs().split("\n")
+        self._blank = False
+        self.paragraph()
+
+    def getvalue(self):
+        self.newline()
+        while self._lines and not self._lines[-1]:
+            self._lines.pop()
+        return u"\n".join(self._lines) + (u"\n" if self._lines else u"")
+
+
+def dumpHtmlElement(e, dump, depth = 0, index = None):
+    '''write the text of html element e and its descendants in dump.
+    depth is the nesting level of lists, index the counter of the
+    enclosing ordered list if any.'''
+    if isinstance(e.tag, basestring): # otherwise comment or PI
+        tag = e.tag.lower()
+        if tag in html_ignored_tags:
+            pass
+        elif tag == "pre":
+            dump.preformatted(e.text_content())
+        else:
+            is_list = tag in ["ul", "ol", "dir", "menu"]
+            # nested lists are not separated by empty lines
+            is_paragraph = tag in html_paragraph_tags and not (is_list and depth)
+            if is_paragraph:
+                dump.paragraph()
+            elif tag in html_block_tags or tag == "br" or is_list:
+                dump.newline()
+            if tag == "img":
+                dump.text(e.get("alt"))
+            elif tag == "li":
+                if index:
+                    index[0] += 1
+                    dump.item(depth, str(index[0]) + ".")
+                else:
+                    dump.item(depth, u"\u2022")
+            if is_list:
+                depth += 1
+                index = [0] if tag == "ol" else None
+            dump.text(e.text)
+            for c in e:
+                dumpHtmlElement(c, dump, depth, index)
+            if tag in ["td", "th"]:
+                dump.separate()
+            if is_list:
+                depth -= 1
+                dump.unindent(depth)
+            if is_paragraph:
+                dump.paragraph()
+            elif tag in html_block_tags:
+                dump.newline()
+    dump.text(e.tail)
+
+
+def lxml_html2text(htmlFileName, textFileName):
+    '''convert the html file htmlFileName into text file textFileName
+    using lxml instead of an external browser. The text is close to
+    what w3m -dump produces.'''
+    with open(htmlFileName, "rb") as htmlFile:
+        lxml_data2text(htmlFile.read(), textFileName)
+
+
+def lxml_data2text(data, textFileName):
+    '''convert the html document data into text file textFileName,
+    like lxml_html2text'''
+    text = u""
+    if data.strip():
+        try:
+            dump = TextDump()
+            dumpHtmlElement(html.document_fromstring(data), dump)
+            text = dump.getvalue()
+        except (etree.ParserError, ValueError):
+            pass                # not html, leave the text empty
+        except RuntimeError:    # too deeply nested for the recursion
+            text = html.document_fromstring(data).text_content()
+    with open(textFileName, "wb") as textFile:
+        textFile.write(text.encode("utf-8"))
+
+
 def w3m_cmd(topic_id, doc_index, options):
     cmd = "w3m"
     cmd += " -T text/html"
@@ -295,13 +848,6 @@ def getLinks(id_links):
     return id_links[1]
 
 
-def filterTopics(til, minl):
-    '''For each topic in til remove it if it doesn't have minl links
-    or above.'''
-
-    return {t:til[t] for t in til if len(getLinks(til[t])) >= minl}
-
-
 def ASCII_strip(s):
     '''Return a string where all non ascii char have been removed'''
     return "".join(c for c in s if ord(c) < 128)
@@ -322,10 +868,11 @@ def createDocuments(til, options):
     global total_n_links
     total_n_links = sum([len(getLinks(til[k])) for k in til])
     
+    jobs = []
     i = 0
     for t in til:
         i += 1
-        print "Download all links of",t
+        print "Prepare the download of all links of",t
         print "Create topic directory"
         t_id = getId(til[t])
         t_dir = topic_dir(options, t_id)
@@ -339,9 +886,43 @@ def createDocuments(til, options):
             topic_cmd = "echo " + ASCII_strip(t) + " > " + t_path
             print topic_cmd
             os.system(topic_cmd)
-        print "Start downloading links"
+        repairTopicDocument(options, t_id)
         t_links = getLinks(til[t])
-        downloadLinks(t_id, t_links, options)
+        jobs += [(t_id, k, l) for k, l in enumerate(t_links)]
+
+    print "Start downloading links"
+    downloadJobs(jobs, options)
+
+
+# topics whose techtc document has been checked by
+# repairTechtcDocument during this run
+repaired_topics = set()
+
+def repairTechtcDocument(tdc):
+    '''remove the last document of the techtc document tdc if it is
+    incomplete, which can happen if the program has been interrupted
+    while writing it.'''
+    end = "</dmoz_doc>\n"
+    if not os.path.exists(tdc):
+        return
+    with open(tdc, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - len(end)))
+        if size == 0 or f.read() == end:
+            return
+        f.seek(0)
+        content = f.read()
+        keep = content.rfind(end) + len(end) if end in content else 0
+        print "Warning: remove the incomplete last document of", tdc
+        f.truncate(keep)
+
+
+def repairTopicDocument(options, topic_id):
+    '''repair the techtc document of topic_id, once per run'''
+    if topic_id not in repaired_topics:
+        repairTechtcDocument(techtc_doc_path(options, topic_id))
+        repaired_topics.add(topic_id)
 
 
 def fillTechtcFormatDocument(options, topic_id, doc_index):
@@ -352,101 +933,448 @@ def fillTechtcFormatDocument(options, topic_id, doc_index):
     if dpt_size >= min_size:
         tdc = techtc_doc_path(options, topic_id)
         print "Fill document",tdc,"in techtc format"
-        rtdc = " >> " + "\"" + tdc + "\""
-        cmd = "echo \"<dmoz_doc>\"" + rtdc
-        # print cmd
-        os.system(cmd)
-        cmd = "echo id=" + str(doc_index) + rtdc
-        # print cmd
-        os.system(cmd)
-        cmd = "echo \"<dmoz_subdoc>\"" + rtdc
-        # print cmd
-        os.system(cmd)
-        cmd = "cat " + dpt + rtdc
-        # print cmd
-        os.system(cmd)
-        cmd = "echo \"</dmoz_subdoc>\"" + rtdc
-        # print cmd
-        os.system(cmd)
-        cmd = "echo \"</dmoz_doc>\"" + rtdc
-        # print cmd
-        os.system(cmd)
+        with open(dpt, "rb") as f:
+            doc = ("<dmoz_doc>\n" + "id=" + str(doc_index) + "\n"
+                   + "<dmoz_subdoc>\n" + f.read()
+                   + "</dmoz_subdoc>\n" + "</dmoz_doc>\n")
+        # write the whole document at once, so that concurrent writers
+        # don't interleave and a crash can only leave an incomplete
+        # last document (removed at the next run)
+        with topicLock(topic_id):
+            repairTopicDocument(options, topic_id)
+            fd = os.open(tdc, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                while doc:
+                    doc = doc[os.write(fd, doc):]
+            finally:
+                os.close(fd)
+        status = "filled"
+        metrics.count("docs_filled")
     else:
         print "Warning: the size of " + dpt + ", " + str(dpt_size) + " is too low (should be " + str(min_size) + " at least)"
+        status = "rejected"
+        metrics.count("docs_too_small")
+    if journal:
+        journal.doc(topic_id, doc_index, status)
 
 
-link_idx = 0
-total_n_links = 0
+def techtcDocumentIds(tdc):
+    '''return the set of ids of the documents in techtc document tdc'''
+    ids = set()
+    if os.path.exists(tdc):
+        with open(tdc) as f:
+            prev = None
+            for l in f:
+                if prev == "<dmoz_doc>\n" and l.startswith("id="):
+                    ids.add(int(l[3:]))
+                prev = l
+    return ids
 
 
-# TODO some links are duplicated between topics, we should optimize so
-# that they are not downloaded multiple times
-def downloadLinks(topic_id, ls, options):
-    '''Download links ls and place the content of each link in a file
-    under topic_id directory. The files are indexed from 0 to
-    len(ls)-1'''
+link_idx = 0
+total_n_links = 0
+# protect link_idx and the techtc documents of the topics when
+# downloading concurrently
+link_idx_lock = threading.Lock()
+topic_locks = {}
+topic_locks_lock = threading.Lock()
+
+def topicLock(topic_id):
+    '''return the lock protecting the techtc document of topic_id'''
+    with topic_locks_lock:
+        if topic_id not in topic_locks:
+            topic_locks[topic_id] = threading.Lock()
+        return topic_locks[topic_id]
+
+
+def link_host(link):
+    return urlparse(link).netloc.lower()
+
+
+def normalize_url(link):
+    '''return link with lower case scheme and host, without default
+    port and fragment, so that equivalent links are equal.'''
+    u = urlparse(link.strip())
+    scheme = u.scheme.lower()
+    netloc = u.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in [("http", "80"), ("https", "443")]:
+        netloc = netloc.rpartition(":")[0]
+    return urlunparse((scheme, netloc, u.path or "/", u.params, u.query, ""))
+
+
+def page_store_url_path(options, link):
+    key = hashlib.sha1(ASCII_strip(normalize_url(link))).hexdigest()
+    return options.page_store + "/url/" + key + ".txt"
+
+def page_store_content_path(options, digest):
+    return options.page_store + "/content/" + digest + ".txt"
+
+
+def linkFile(src, dst):
+    '''hardlink src to dst, or copy it if src and dst are not on the
+    same filesystem (or the filesystem doesn't support hardlinks).'''
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        shutil.copyfile(src, dst)
+
+
+def replaceFile(src, dst):
+    '''replace dst by a hardlink (or a copy) of src'''
+    tmp = dst + ".tmp"
+    linkFile(src, tmp)
+    os.rename(tmp, dst)
+
+
+def createPageStore(options):
+    for d in [options.page_store, options.page_store + "/url",
+              options.page_store + "/content"]:
+        if not os.path.exists(d):
+            os.mkdir(d)
+
+
+def inPageStore(options, link):
+    '''return whether the text of link is in the page store. An empty
+    text left by an older version (failed download) doesn't count.'''
+    up = page_store_url_path(options, link)
+    return os.path.exists(up) and os.path.getsize(up) > 0
+
+
+def storePage(options, link, dpt):
+    '''add the text document dpt of link to the page store. If its
+    content is already in the store, dpt is replaced by a hardlink to
+    it. An empty document (failed download) is not stored, so that
+    its link is downloaded again by the next runs.'''
+    with open(dpt, "rb") as f:
+        data = f.read()
+    if not data:
+        return
+    cp = page_store_content_path(options, hashlib.sha1(data).hexdigest())
+    # other threads may store the same content or link at the same
+    # time, the first link wins
+    try:
+        linkFile(dpt, cp)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        replaceFile(cp, dpt)
+    up = page_store_url_path(options, link)
+    try:
+        if not inPageStore(options, link):
+            replaceFile(cp, up)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class DownloadScheduler:
+    '''Run download jobs (topic_id, doc_index, link) over a pool of
+    workers threads. A job is composed of 2 steps, fetch then
+    process, which is given the result of fetch. No more than
+    host_jobs jobs of the same host are fetched at the same time and
+    there are at least host_delay seconds between the start of 2
+    fetches of the same host. The process step (html to text
+    conversion, etc) doesn't count as part of it so it runs while
+    other links are fetched.'''
+    def __init__(self, workers, host_jobs, host_delay):
+        self._workers = max(1, workers)
+        self._host_jobs = max(1, host_jobs)
+        self._host_delay = host_delay
+        self._cond = threading.Condition()
+        self._pending = OrderedDict() # host -> list of jobs
+        self._running = {}            # host -> number of fetching jobs
+        self._last = {}               # host -> start time of the last fetch
+        self._error = None
+
+    def run(self, jobs, fetch, process):
+        for job in jobs:
+            self._pending.setdefault(link_host(job[2]), []).append(job)
+        for h in self._pending:
+            self._pending[h].reverse() # so that pop returns the first job
+        threads = [threading.Thread(target = self._work,
+                                    args = (fetch, process))
+                   for _ in range(self._workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():   # join with a timeout to allow ctrl-c
+                t.join(1)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _next(self):
+        '''wait until a job can be fetched and return it with its
+        host. Return None when there is no more job.'''
+        with self._cond:
+            while self._pending and not self._error:
+                now = time.time()
+                wait = None
+                for h in self._pending:
+                    if self._running.get(h, 0) >= self._host_jobs:
+                        continue
+                    d = self._last.get(h, now - self._host_delay) + self._host_delay - now
+                    if d > 0:
+                        wait = d if wait is None else min(wait, d)
+                        continue
+                    job = self._pending[h].pop()
+                    if not self._pending[h]:
+                        del self._pending[h]
+                    self._running[h] = self._running.get(h, 0) + 1
+                    self._last[h] = now
+                    return job, h
+                # wait for a host delay to expire or a fetch to end
+                self._cond.wait(wait)
+            return None
+
+    def _work(self, fetch, process):
+        while True:
+            n = self._next()
+            if n is None:
+                return
+            job, h = n
+            try:
+                try:
+                    result = fetch(job)
+                finally:
+                    with self._cond:
+                        self._running[h] -= 1
+                        self._cond.notify_all()
+                process(job, result)
+            except BaseException:
+                with self._cond:
+                    self._error = self._error or sys.exc_info()
+                    self._cond.notify_all()
+                return
+
+
+# fetcher of option -F http, created by downloadJobs
+http_fetcher = None
+
+def downloadJobs(jobs, options):
+    '''Download the links of jobs, a list of (topic_id, doc_index,
+    link), using options.j concurrent downloads. Unless the page store
+    is disabled, a link shared by several jobs is downloaded only once
+    and links already in the page store are not downloaded again.'''
+
+    global link_idx
+    todo = []
+    followers = {}              # normalized link -> jobs reusing it
+    fill = []                   # jobs only left to be filled
+    for job in jobs:
+        dpt = doc_path_txt(options, job[0], job[1])
+        status = journal.docs.get(job[:2]) if journal else None
+        if status in ["filled", "rejected"] or \
+           (not journal and os.path.exists(dpt)):
+            link_idx += 1
+            print "Document", dpt, "has already been downloaded"
+        elif status == "converted":
+            link_idx += 1
+            fill.append(job)
+        elif options.page_store:
+            key = normalize_url(job[2])
+            if key in followers:
+                followers[key].append(job)
+            else:
+                followers[key] = []
+                todo.append(job)
+        else:
+            todo.append(job)
+
+    if options.page_store:
+        createPageStore(options)
+
+    # fill the documents converted but not filled when the previous
+    # run has been interrupted, unless the fill has been done but not
+    # recorded
+    filled = {}
+    for topic_id, i, _ in fill:
+        if topic_id not in filled:
+            filled[topic_id] = techtcDocumentIds(techtc_doc_path(options, topic_id))
+        if i in filled[topic_id]:
+            journal.doc(topic_id, i, "filled")
+        else:
+            fillTechtcFormatDocument(options, topic_id, i)
 
-    i = 0
-    for l in ls:
-        global link_idx
+    global html2text_pool, http_fetcher
+    if options.H == "lxml" and options.html2text_jobs > 1:
+        html2text_pool = multiprocessing.Pool(options.html2text_jobs)
+    if options.F == "http":
+        http_fetcher = HTTPFetcher(options.Q, options.timeout,
+                                   options.deadline,
+                                   idle_connections = options.host_jobs)
+
+    try:
+        scheduler = DownloadScheduler(options.j, options.host_jobs,
+                                      options.host_delay)
+        scheduler.run(todo,
+                      lambda job: fetchLink(job, options),
+                      lambda job, data: processLink(job, options,
+                                                    followers.get(normalize_url(job[2]), []),
+                                                    data))
+    finally:
+        if html2text_pool:
+            html2text_pool.terminate()
+            html2text_pool = None
+        if http_fetcher:
+            http_fetcher.close()
+            http_fetcher = None
+
+
+def fetchLink(job, options):
+    '''download the link of job, in its html file with wget, or
+    return its content with the http fetcher (option -F). Return None
+    if the content is not to be fetched again.'''
+    global link_idx
+    topic_id, i, l = job
+    with link_idx_lock:
         link_idx += 1
+        idx = link_idx
         print "Download link " + str(link_idx) + "/" + str(total_n_links)
-        dpt = doc_path_txt(options, topic_id, i)
-        if os.path.exists(dpt):
-            print "Document", dpt, "has already been downloaded"
-        else:
-            # download links
-            cmd = wget_cmd(topic_id, i, l, options)
-            print cmd
-            os.system(cmd)
-            # convert them into text
-            cmd = html2text_cmd(topic_id, i, options)
-            print cmd
-            os.system(cmd)
-            # remove now useless html file
-            cmd = "rm \"" + doc_path_html(options, topic_id, i) + "\""
+    metrics.progress("download", idx, total_n_links)
+    if options.page_store and inPageStore(options, l):
+        print "Link", l, "is already in the page store"
+        metrics.count("links_stored")
+        return None
+    if journal and journal.docs.get((topic_id, i)) == "downloaded" \
+       and os.path.exists(doc_path_html(options, topic_id, i)):
+        print "Link", l, "has already been downloaded"
+        return None
+    if http_fetcher:
+        url = str(ASCII_strip(l))
+        print "Fetch", url
+        try:
+            data = http_fetcher.fetch(url)
+        except FetchError as e:
+            print "Warning: cannot fetch " + url + ", " + str(e)
+            data = ""
+        size = len(data)
+    else:
+        data = None
+        cmd = wget_cmd(topic_id, i, l, options)
+        print cmd
+        os.system(cmd)
+        dph = doc_path_html(options, topic_id, i)
+        size = os.path.getsize(dph) if os.path.exists(dph) else 0
+    if size:
+        metrics.count("links_fetched")
+        metrics.count("bytes_downloaded", size)
+    else:
+        metrics.count("links_failed")
+    # the content fetched by -F http is only in memory
+    if journal and data is None:
+        journal.doc(topic_id, i, "downloaded")
+    return data
+
+
+def processLink(job, options, followers = [], data = None):
+    '''convert the html of job (data, or its html file if None) into
+    text and fill it in the techtc document of its topic. Then fill
+    the same text in the techtc documents of the followers, the jobs
+    with the same link.'''
+    global link_idx
+    topic_id, i, l = job
+    dpt = doc_path_txt(options, topic_id, i)
+    if options.page_store and inPageStore(options, l):
+        replaceFile(page_store_url_path(options, l), dpt)
+    else:
+        # convert them into text
+        html2text(topic_id, i, options, data)
+        # remove now useless html file
+        dph = doc_path_html(options, topic_id, i)
+        if os.path.exists(dph):
+            cmd = "rm \"" + dph + "\""
             print cmd
             os.system(cmd)
-            # fill document in techtc format for that topic
-            fillTechtcFormatDocument(options, topic_id, i)
-        i += 1
-
-
-def dictTopicIdLinks(topics, til, options):
+        if options.page_store:
+            storePage(options, l, dpt)
+    if journal:
+        journal.doc(topic_id, i, "converted")
+    # fill document in techtc format for that topic
+    fillTechtcFormatDocument(options, topic_id, i)
+    for f_topic_id, f_i, f_l in followers:
+        with link_idx_lock:
+            link_idx += 1
+            idx = link_idx
+            print "Reuse link " + str(link_idx) + "/" + str(total_n_links), f_l
+        metrics.progress("download", idx, total_n_links)
+        metrics.count("links_reused")
+        replaceFile(dpt, doc_path_txt(options, f_topic_id, f_i))
+        if journal:
+            journal.doc(f_topic_id, f_i, "converted")
+        fillTechtcFormatDocument(options, f_topic_id, f_i)
+
+
+def dictTopicIdLinks(topics, til, options, side = None):
     '''Insert til[topic]=(id, links) for each topic of topics if
-    not already in til.'''
+    not already in til. side (pos or neg) is used to record them in
+    the journal.'''
+
+    topics = [t for t in topics if t not in til]
+    found = dictLinks(options.c, topics)
+    for topic, _, l in found:
+        clinks.insert((options.c, topic), l)
 
     if options.u:               # random link selection
-        # TODO add options instead of that ad hoc number
-        f = lambda x: choiceCollectLinks(x, options, options.L*100) 
+        masses = dict((t, walkMass(t, options)) for t, _, _ in found)
+        # get the links of all categories at once
+        prefetchLinks(options.c, set(chain.from_iterable(masses.values())))
     else:                       # deterministic link selection
-        f = lambda x: collectLinksBFS(x, options)
+        bfs = collectLinksBFSBatch([t for t, _, _ in found], options)
 
-    cf = open(options.c)
     i = 0
-    for _,t in etree.iterparse(cf, tag = ns()+"Topic"):
-        topic = t.attrib[r()+"id"]
-        if topic in topics and topic not in til:
-            i += 1
-            print "Topic", i
-            # get id
-            t_id = t.findtext(ns()+"catid")
-            print "id("+topic+") =", t_id
-            # get links
-            t_links = f(topic)
-            #  insert mapping
-            til[topic] = (t_id, t_links)
-        t.clear()
-        if len(til) == len(topics): # no need to parse further
-            break
-    cf.close()
+    for topic, t_id, _ in found:
+        i += 1
+        print "Topic", i
+        print "id("+topic+") =", t_id
+        # get links
+        if options.u:
+            t_links = sampleLinks(masses[topic], options)
+        else:
+            t_links = bfs[topic]
+            printLinks(t_links)
+        #  insert mapping
+        til[topic] = (t_id, t_links)
+        metrics.count("topics_resolved")
+        if journal:
+            journal.topic(side, topic, t_id, t_links)
         
 
 def dataset_dir(options, p_id, n_id):
     return options.O + "/" + "Exp_" + p_id + "_" + n_id
 
 
+def placeFile(src, dst, mode):
+    '''place file src at dst according to mode, copy, hardlink,
+    symlink or reflink. A hardlink falls back to a copy if src and dst
+    are not on the same filesystem, so does a reflink if the
+    filesystem doesn't support it.'''
+    if not os.path.exists(src):
+        print "Warning:", src, "does not exist"
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == "hardlink":
+        linkFile(src, dst)
+    elif mode == "symlink":
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+    elif mode == "reflink":
+        cmd = "cp --reflink=auto \"" + src + "\" \"" + dst + "\""
+        print cmd
+        os.system(cmd)
+    else:
+        cmd = "cp \"" + src + "\" \"" + dst + "\""
+        print cmd
+        os.system(cmd)
+
+
 def organizeDocuments(spl, til, options):
+    # the documents of an interrupted run may not have been repaired
+    # yet (option -C)
+    for t_id in set(getId(v) for v in til[0].values() + til[1].values()):
+        repairTopicDocument(options, t_id)
     for p,n in spl:
         p_id = getId(til[0][p])
         n_id = getId(til[1][n])
@@ -454,17 +1382,81 @@ def organizeDocuments(spl, til, options):
         dsd_p = dsd + "/all_pos.txt"
         dsd_n = dsd + "/all_neg.txt"
         print "Create dataset directory for " + p + "vs" + n
-        cmd = "mkdir " + dsd
-        print cmd
-        os.system(cmd)
-        print "Move the positve documents in it"
-        cmd = "cp " + techtc_doc_path(options, p_id) + " " + dsd_p
-        print cmd
-        os.system(cmd)
-        print "Move the negative documents in it"
-        cmd = "cp " + techtc_doc_path(options, n_id) + " " + dsd_n
-        print cmd
-        os.system(cmd)
+        if not os.path.exists(dsd):
+            cmd = "mkdir " + dsd
+            print cmd
+            os.system(cmd)
+        print "Place the positive documents in it (" + options.link_mode + ")"
+        placeFile(techtc_doc_path(options, p_id), dsd_p, options.link_mode)
+        print "Place the negative documents in it (" + options.link_mode + ")"
+        placeFile(techtc_doc_path(options, n_id), dsd_n, options.link_mode)
+
+
+class Journal:
+    '''Append-only journal of the building process, one JSON record
+    per line, written as the building goes (chosen subtopics, ids and
+    links of each topic, pairs of topics, status of each document).
+    If the journal file already exists it is replayed first so that
+    an interrupted build can be resumed where it stopped.'''
+    def __init__(self, fileName, readOnly = False):
+        self.subtopics = {"pos": [], "neg": []}
+        self.til = {"pos": {}, "neg": {}}
+        self.pairs = []         # (positive topic, negative topic)
+        self.docs = {}          # (topic_id, doc_index) -> status
+        self._lock = threading.Lock()
+        self._file = None
+        if os.path.exists(fileName):
+            self._replay(fileName, readOnly)
+        if not readOnly:
+            self._file = open(fileName, "a")
+
+    def _replay(self, fileName, readOnly):
+        with open(fileName, "rb+") as f:
+            end = 0
+            for l in f:
+                try:
+                    rec = json.loads(l)
+                except ValueError: # incomplete last record
+                    break
+                end += len(l)
+                if rec["e"] == "subtopic":
+                    self.subtopics[rec["side"]].append(rec["topic"])
+                elif rec["e"] == "topic":
+                    self.til[rec["side"]][rec["topic"]] = (rec["id"], rec["links"])
+                elif rec["e"] == "pair":
+                    self.pairs.append((rec["pos"], rec["neg"]))
+                elif rec["e"] == "doc":
+                    self.docs[(rec["id"], rec["i"])] = rec["status"]
+            if not readOnly:
+                f.truncate(end)
+
+    def _write(self, rec):
+        with self._lock:
+            self._file.write(json.dumps(rec) + "\n")
+            self._file.flush()
+
+    def subtopic(self, side, topic):
+        self._write({"e": "subtopic", "side": side, "topic": topic})
+
+    def topic(self, side, topic, t_id, links):
+        self._write({"e": "topic", "side": side, "topic": topic,
+                     "id": t_id, "links": list(links)})
+
+    def pair(self, p):
+        self._write({"e": "pair", "pos": p[0], "neg": p[1]})
+
+    def doc(self, topic_id, doc_index, status):
+        self.docs[(topic_id, doc_index)] = status
+        self._write({"e": "doc", "id": topic_id, "i": doc_index,
+                     "status": status})
+
+# journal of the building, set by option -J
+journal = None
+
+
+def isJournal(fileName):
+    with open(fileName, "rb") as f:
+        return f.read(1) in ["{", ""]
 
 
 def buildTopicsIdsLinks(options):
@@ -475,43 +1467,39 @@ def buildTopicsIdsLinks(options):
     right option is selected it can save preriodically the building in
     to a dump file).'''
 
-    if options.i:               # start from a dump file
+    pts = set()                 # positive subtopics
+    nts = set()                 # negative subtopics
+    if options.i and isJournal(options.i): # start from a journal
+        print "The building will start from journal", options.i
+        j = journal if options.J == options.i else Journal(options.i, True)
+        ptil, ntil = j.til["pos"], j.til["neg"]
+        pts.update(j.subtopics["pos"])
+        nts.update(j.subtopics["neg"])
+    elif options.i:             # start from a dump file
         print "The building will start from file", options.i
         inputDumpFile = open(options.i)
         ptil, ntil = pickle.load(inputDumpFile)
+        pts.update(ptil.keys())
+        nts.update(ntil.keys())
     else:                       # start from scratch
         print "No dump file has been provided so the building will start from scratch"
         ptil = {}
         ntil = {}
         
-    print "Choose", options.S, "positive subtopics of",options.posCR
-    pts = set(ptil.keys())            # positive subtopics
-    choiceSubtopics(options.posCR, pts, options)
-
-    print "Choose", options.S, "negative subtopics of",options.negCR
-    nts = set(ntil.keys())            # negative subtopics
-    choiceSubtopics(options.negCR, nts, options)
+    minl = int(options.l * options.L)
+    print "Choose", options.S, "positive subtopics of", options.posCR, "with at least", minl, "links"
+    pts = choiceSubtopics(options.posCR, pts, ptil, options, "pos")
 
-    print "Associate id and", options.L, "links to each positive subtopic"
-    dictTopicIdLinks(pts, ptil, options)
+    print "Choose", options.S, "negative subtopics of", options.negCR, "with at least", minl, "links"
+    nts = choiceSubtopics(options.negCR, nts, ntil, options, "neg")
 
-    print "Associate id and", options.L, "links to each negative subtopic"
-    dictTopicIdLinks(nts, ntil, options)
+    # leave out the topics resolved but not chosen
+    ptil = dict((t, ptil[t]) for t in pts)
+    ntil = dict((t, ntil[t]) for t in nts)
 
     if options.o:
         with open(options.o, "w") as outputDumpFile:
             pickle.dump((ptil, ntil), outputDumpFile)
-    
-    minl = int(options.l * options.L)
-    print "Remove postive topics with less than", minl, "links"
-    ptil_len = len(ptil)
-    ptil = filterTopics(ptil, minl)
-    print ptil_len - len(ptil), "topics have been removed"
-
-    print "Remove negative topics with less than", minl, "links"
-    ntil_len = len(ntil)
-    ntil = filterTopics(ntil, minl)
-    print ntil_len - len(ntil), "topics have been removed"
 
     return ptil, ntil
 
@@ -527,35 +1515,54 @@ def build_techtc(options):
 
     seed(options.random_seed)   # seed the random generator
 
+    global journal
+    if options.J:
+        if os.path.exists(options.J) and not options.i:
+            options.i = options.J # resume from the journal
+        journal = Journal(options.J)
+
+    if options.I:
+        with metrics.stage("index"):
+            loadContentIndex(options.c)
+
+    if options.T:
+        with metrics.stage("structure"):
+            print "Load the structure file", options.s, "in memory"
+            tree = loadStructure(options.s, tuple(options.subtopic_tags))
+            print len(tree), "topics have been loaded"
+
     til = buildTopicsIdsLinks(options)
 
-    print "Build", options.S, "pairs of positive and negative topic"
-    spl = choiceSubtopicsPairs(til, options)
+    with metrics.stage("pairs"):
+        print "Build", options.S, "pairs of positive and negative topic"
+        spl = choiceSubtopicsPairs(til, options)
     
     if not options.P:
 
         if not options.C:
-            print "Create documents in techtc format for all subtopics"
-            createDocuments(til_union(til), options)
+            with metrics.stage("download"):
+                print "Create documents in techtc format for all subtopics"
+                createDocuments(til_union(til), options)
         else:
             print "Skip creation of documents in techtc format"
 
-        print "Organize documents according to the list of pairs of subtopics"
-        organizeDocuments(spl, til, options)
+        with metrics.stage("organize"):
+            print "Organize documents according to the list of pairs of subtopics"
+            organizeDocuments(spl, til, options)
 
 
 def main():
-    usage = "Usage: %prog [Options]"
+    usage = "Usage: %prog [index] [Options]"
     parser = OptionParser(usage)
     parser.add_option("-r", "--random-seed",
                       default=1,
                       help="Random seed. [default: %default]")
     parser.add_option("-c", "--content-file",
                       dest="c", default="content_stripped.rdf.u8",
-                      help="ODP RDF content file. [default: %default]")
+                      help="ODP RDF content file, possibly compressed (.gz, .bz2 or .xz). [default: %default]")
     parser.add_option("-s", "--structure-file",
                       dest="s", default="structure_stripped.rdf.u8",
-                      help="ODP RDF structure file. [default: %default]")
+                      help="ODP RDF structure file, possibly compressed (.gz, .bz2 or .xz). [default: %default]")
     parser.add_option("-p", "--positive-category-root",
                       dest="posCR", default="Top/Arts",
                       help="Category root of the sub-categories used for positive documents. [default: %default]")
@@ -573,16 +1580,19 @@ def main():
                       help="Maximum mumber of documents per category. [default: %default]")
     parser.add_option("-l", "--minimum-proportion-document-number",
                       type="float", dest="l", default=0.6,
-                      help="In case enough links cannot be retrieved to reach the right document number (option -L) then what proportion of it we tolerate. [default: %default]")
+                      help="In case enough links cannot be retrieved to reach the right document number (option -L) then what proportion of it we tolerate. The subtopics with fewer links are replaced by others when they are chosen. [default: %default]")
     parser.add_option("-u", "--random-link-selection",
                       action="store_true", dest="u",
-                      help="Select randomly the links within a subcategory instead of in BFS order. This method is much slower.")
+                      help="Select randomly the links within a subcategory (and its subcategories according to option -R) instead of in BFS order.")
     parser.add_option("-o", "--output-dump-file",
                       dest="o", default="",
                       help="File where to dump intermediary results to build techtc. Useful in case of crash. [default: %default]")
     parser.add_option("-i", "--input-dump-file",
                       dest="i", default="",
-                      help="Dump file to load so that the process of building the topics and links doesn't start from scratch. If no file is given then it starts from scratch. [default: %default]")
+                      help="Dump file (or journal, see option -J) to load so that the process of building the topics and links doesn't start from scratch. If no file is given then it starts from scratch. [default: %default]")
+    parser.add_option("-J", "--journal",
+                      dest="J", default="",
+                      help="Journal file where to record the progress of the building as it goes (chosen subtopics, links of each topic, pairs of topics, status of each document). If the journal already exists the building resumes from it, only the unfinished work is redone. [default: %default]")
     parser.add_option("-O", "--output-directory",
                       dest="O", default="__default__",
                       help="Directory where to download the web pages and place the dataset collection. [default: techtc_SIZE] where SIZE is the size of the dataset collection given by option S.")
@@ -597,28 +1607,104 @@ def main():
                       help="Perform only parsing (building of topics and links), do not download web pages, and save the result in the file provided with options -o.")
     parser.add_option("-C", "--not-create-documents", action="store_true",
                       dest="C",
-                      help="If the documents have been created but not organized yet (because it takes a lot of disk space) then that option can be used. Normally the recovery and continuation is automatic but with that option the program will not try to create missing intermediate documents therefore they can be deleted to get more space. You need to is specifying the existing output directory with option -O and the dump file with option -i.")
+                      help="If the documents have been created but not organized yet (because it takes a lot of disk space, see option --link-mode) then that option can be used. Normally the recovery and continuation is automatic but with that option the program will not try to create missing intermediate documents therefore they can be deleted to get more space. You need to is specifying the existing output directory with option -O and the dump file with option -i.")
+    parser.add_option("--link-mode", type="choice",
+                      choices=["copy", "hardlink", "symlink", "reflink"],
+                      dest="link_mode", default="copy",
+                      help="How the documents of the topics are placed in the dataset directories, copy, hardlink, symlink or reflink (copy-on-write copy, on filesystems supporting it). Except copy, they don't take more disk space when a topic appears in several datasets. hardlink falls back to copy across filesystems, so does reflink on filesystems that don't support it. [default: %default]")
     parser.add_option("-t", "--subtopic-tags", action="append",
                       default=["narrow", "symbolic"],
                       help="Use the following tag prefixes to find subtopics of a given topic.")
+    parser.add_option("-T", "--load-structure", action="store_true",
+                      dest="T",
+                      help="Parse the structure file once and keep the topic hierarchy in memory instead of parsing the file again for each topic. Much faster but requires enough memory to hold the hierarchy.")
+    parser.add_option("-I", "--content-index", action="store_true",
+                      dest="I",
+                      help="Look up topics and links in a persistent index of the content file (the content file name followed by .idx) instead of parsing the content file. The index is built if it doesn't exist or if the content file has changed. It can also be built alone with the command index.")
+    parser.add_option("--cache-entries", type="int",
+                      dest="cache_entries", default=0,
+                      help="Maximum number of entries of each cache (links and subtopics), the least recently used entries are evicted beyond that. 0 means no limit. [default: %default]")
+    parser.add_option("--cache-memory", type="int",
+                      dest="cache_memory", default=0,
+                      help="Maximum memory in MB of each cache (links and subtopics), the least recently used entries are evicted beyond that. 0 means no limit. [default: %default]")
+    parser.add_option("--cache-stats-file",
+                      dest="cache_stats_file", default="",
+                      help="File where to write the statistics of the caches in JSON format at exit. They are printed on the stdout anyway. [default: %default]")
+    parser.add_option("-j", "--jobs", type="int",
+                      dest="j", default=1,
+                      help="Number of links downloaded concurrently. [default: %default]")
+    parser.add_option("--host-jobs", type="int",
+                      dest="host_jobs", default=1,
+                      help="Maximum number of links of the same host downloaded concurrently. [default: %default]")
+    parser.add_option("--host-delay", type="float",
+                      dest="host_delay", default=0,
+                      help="Minimum delay in seconds between the start of 2 downloads from the same host. [default: %default]")
+    parser.add_option("--page-store",
+                      dest="page_store", default="__default__",
+                      help="Directory where to store the text of each downloaded link, so that a link shared by several topics (or several runs) is downloaded and converted only once. [default: OUTPUT_DIRECTORY/pages] where OUTPUT_DIRECTORY is given by option -O.")
+    parser.add_option("--no-page-store", action="store_true",
+                      dest="no_page_store",
+                      help="Do not use a page store, each link is downloaded for each topic it belongs to.")
+    parser.add_option("-F", "--fetcher", type="choice",
+                      choices=["wget", "http"], dest="F", default="wget",
+                      help="How the web pages are downloaded, wget (one process per link, following the links of the page up to the quota) or http, an in-process fetcher reusing the connections to the same host and handing the page to the html to text converter without writing it on disk, which fetches only the page itself. [default: %default]")
+    parser.add_option("--timeout", type="float",
+                      dest="timeout", default=3,
+                      help="Maximum number of seconds to wait for the connection to a host or for data from it. [default: %default]")
+    parser.add_option("--deadline", type="float",
+                      dest="deadline", default=30,
+                      help="Maximum number of seconds to download a link, redirects included, with -F http. [default: %default]")
     parser.add_option("-H", "--html2text", dest="H",
                       default="w3m",
-                      help="Software to convert html into text. The supported softwares are w3m, lynx, elinks, links, links2. [default: %default]")
+                      help="Software to convert html into text. The supported softwares are w3m, lynx, elinks, links, links2, and lxml which converts in-process without an external browser. [default: %default]")
+    parser.add_option("--html2text-jobs", type="int",
+                      dest="html2text_jobs", default=multiprocessing.cpu_count(),
+                      help="Number of processes converting html into text with -H lxml. [default: number of CPUs]")
+    metrics.add_options(parser)
     (options, args) = parser.parse_args()
 
-    if len(args) != 0:
+    if len(args) > 1 or (args and args[0] != "index"):
         parser.error("incorrect number of arguments. Use --help to get more information")
 
-    if options.O == "__default__":
-        options.O = "techtc"+str(options.S)
+    metrics.start(options)
 
-    build_techtc(options)
+    if args:                    # only build the index of the content file
+        with metrics.stage("index"):
+            buildContentIndex(options.c, content_index_path(options.c))
+        metrics.finish(options)
+        return
 
-    # print "Cache failures for links =", clinks.get_failures()
-    # print "Cache hits for links =", clinks.get_hits()
+    if options.O == "__default__":
+        options.O = "techtc"+str(options.S)
 
-    # print "Cache failures for subtopics =", csubtopics.get_failures()
-    # print "Cache hits for subtopics =", csubtopics.get_hits()
+    if options.no_page_store:
+        options.page_store = ""
+    elif options.page_store == "__default__":
+        options.page_store = options.O + "/pages"
+
+    cache_entries = options.cache_entries or cache_size
+    cache_memory = options.cache_memory * 2**20 if options.cache_memory else cache_bytes
+    clinks.resize(cache_entries, cache_memory)
+    csubtopics.resize(cache_entries, cache_memory)
+
+    try:
+        build_techtc(options)
+    finally:
+        reportCaches(options)
+        metrics.finish(options)
+
+
+def reportCaches(options):
+    '''print the statistics of the caches, and write them in JSON
+    format if option --cache-stats-file is given.'''
+    stats = {"links": clinks.stats(), "subtopics": csubtopics.stats()}
+    for name in sorted(stats):
+        print "Cache " + name + ":", ", ".join(k + " = " + str(v) for k, v in sorted(stats[name].items()))
+        for k in ["calls", "hits", "failures", "evictions"]:
+            metrics.count("cache_" + name + "_" + k, stats[name][k])
+    if options.cache_stats_file:
+        with open(options.cache_stats_file, "w") as statsFile:
+            json.dump(stats, statsFile, indent = 2, sort_keys = True)
 
 
 if __name__ == "__main__":
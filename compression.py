@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Open compressed (gz, bz2, xz) or uncompressed files as streams
+
+import gzip
+import bz2
+import subprocess
+from distutils.spawn import find_executable
+
+# decompressing commands writing on the stdout, by extension, in order
+# of preference (the parallel ones first)
+decompressors = {".gz": [["pigz", "-dc"], ["gzip", "-dc"]],
+                 ".bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"],
+                          ["bzip2", "-dc"]],
+                 ".xz": [["xz", "-T0", "-dc"]]}
+
+# compressing commands reading the stdin and writing on the stdout
+compressors = {".gz": [["pigz", "-c"], ["gzip", "-c"]],
+               ".bz2": [["lbzip2", "-c"], ["pbzip2", "-c"], ["bzip2", "-c"]],
+               ".xz": [["xz", "-T0", "-c"]]}
+
+
+def compression_ext(fileName):
+    '''return the compression extension of fileName (.gz, .bz2 or .xz)
+    or the empty string if it is not compressed'''
+    for ext in decompressors:
+        if fileName.endswith(ext):
+            return ext
+    return ""
+
+
+def find_cmd(cmds):
+    '''return the first command of cmds which is installed, None if
+    there is none'''
+    for cmd in cmds:
+        if find_executable(cmd[0]):
+            return cmd
+    return None
+
+
+class PipeFile:
+    '''File object reading the stdout (or writing the stdin) of a
+    process, the process is waited for when the file is closed.'''
+    def __init__(self, proc, f, out = None):
+        self._proc = proc
+        self._f = f
+        self._out = out
+        self._pos = 0           # number of bytes read or written
+        self._eof = False       # whether the reader reached the end
+
+    def read(self, size = -1):
+        s = self._f.read(size)
+        self._pos += len(s)
+        if size < 0 or (size and not s):
+            self._eof = True
+        return s
+
+    def readline(self, size = -1):
+        s = self._f.readline(size)
+        self._pos += len(s)
+        if size and not s:
+            self._eof = True
+        return s
+
+    def write(self, s):
+        self._f.write(s)
+        self._pos += len(s)
+
+    def tell(self):
+        return self._pos
+
+    def __iter__(self):
+        for l in self._f:
+            self._pos += len(l)
+            yield l
+        self._eof = True
+
+    def close(self):
+        if self._f.closed:
+            return
+        # the process may not have exited yet even if the reader has
+        # reached the end, it is terminated only if the reader stopped
+        # before
+        terminated = False
+        if self._out is None and not self._eof and self._proc.poll() is None:
+            self._proc.terminate()
+            terminated = True
+        self._f.close()
+        code = self._proc.wait()
+        if self._out:
+            self._out.close()
+        # a corrupt or truncated input fails the decompressor
+        if code and not terminated:
+            raise IOError("%s failed with code %d" % (self._proc.cmd, code))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def python_open(fileName, ext, mode):
+    '''open a compressed file with the python modules, slower than the
+    external commands'''
+    if ext == ".gz":
+        return gzip.open(fileName, mode)
+    if ext == ".bz2":
+        return bz2.BZ2File(fileName, mode)
+    try:
+        import lzma             # python 3 or backports.lzma
+    except ImportError:
+        from backports import lzma
+    return lzma.open(fileName, mode)
+
+
+def open_input(fileName):
+    '''open fileName for reading in binary mode. If its extension is
+    .gz, .bz2 or .xz it is decompressed on the fly, with a parallel
+    decompressor if one is installed.'''
+    ext = compression_ext(fileName)
+    if not ext:
+        return open(fileName, "rb")
+    cmd = find_cmd(decompressors[ext])
+    if cmd is None:
+        return python_open(fileName, ext, "rb")
+    proc = subprocess.Popen(cmd + [fileName], stdout = subprocess.PIPE,
+                            bufsize = 1 << 20)
+    proc.cmd = cmd[0]
+    return PipeFile(proc, proc.stdout)
+
+
+def open_output(fileName):
+    '''open fileName for writing in binary mode. If its extension is
+    .gz, .bz2 or .xz it is compressed on the fly, with a parallel
+    compressor if one is installed.'''
+    ext = compression_ext(fileName)
+    if not ext:
+        return open(fileName, "wb")
+    cmd = find_cmd(compressors[ext])
+    if cmd is None:
+        return python_open(fileName, ext, "wb")
+    out = open(fileName, "wb")
+    proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = out,
+                            bufsize = 1 << 20)
+    proc.cmd = cmd[0]
+    return PipeFile(proc, proc.stdin, out)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# Fetch web pages in-process over keep-alive connections
+
+import time
+import socket
+import httplib
+import threading
+from urllib import quote
+from urlparse import urlsplit, urljoin
+import metrics
+
+# characters left as they are in the path and query of the urls
+url_safe = "/%:@&=+$,;~!*'()?#[]-._"
+
+user_agent = "Mozilla/5.0 (compatible; techtc-builder)"
+
+redirect_statuses = [301, 302, 303, 307, 308]
+
+
+class FetchError(Exception):
+    pass
+
+
+class Deadline:
+    '''deadline of a fetch. When it passes, the socket of the
+    connection being used is shut down, which interrupts a read or a
+    write whatever the server does (sending data slowly...).'''
+    def __init__(self, seconds):
+        self.end = time.time() + seconds
+        self.expired = False
+        self._conn = None
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def watch(self, conn):
+        '''set the connection to shut down when the deadline passes'''
+        with self._lock:
+            self._conn = conn
+
+    def cancel(self):
+        self._timer.cancel()
+
+    def _expire(self):
+        with self._lock:
+            self.expired = True
+            sock = self._conn and self._conn.sock
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class HTTPFetcher:
+    '''Fetch urls over http or https, the connections are kept alive
+    and shared by the threads calling fetch, so that the links of the
+    same host reuse them. At most quota bytes of a page are read, the
+    connection being closed if the page is larger, and a fetch is
+    aborted after deadline seconds whatever happens (slow server,
+    redirects...), timeout being the maximum time to wait for the
+    connection or for data.'''
+    def __init__(self, quota, timeout = 3, deadline = 30,
+                 max_redirects = 5, idle_connections = 4):
+        self._quota = quota
+        self._timeout = timeout
+        self._deadline = deadline
+        self._max_redirects = max_redirects
+        self._idle_connections = idle_connections
+        self._idle = {}         # (scheme, host) -> idle connections
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        '''return the content of url, at most quota bytes of it.
+        Raise FetchError if it cannot be fetched.'''
+        deadline = Deadline(self._deadline)
+        try:
+            for _ in range(self._max_redirects + 1):
+                status, location, body = self._get(url, deadline)
+                if status in redirect_statuses and location:
+                    url = urljoin(url, location)
+                    metrics.count("http_redirects")
+                elif 200 <= status < 300:
+                    return body
+                else:
+                    raise FetchError("HTTP status " + str(status))
+            raise FetchError("too many redirects")
+        finally:
+            deadline.cancel()
+
+    def close(self):
+        '''close the idle connections'''
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    def _connection(self, key):
+        '''return an idle connection to key (scheme, host) and whether
+        it has been used before, or a new one'''
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+        metrics.count("http_connections")
+        if key[0] == "https":
+            return httplib.HTTPSConnection(key[1]), False
+        return httplib.HTTPConnection(key[1]), False
+
+    def _release(self, key, conn, deadline):
+        deadline.watch(None)
+        if deadline.expired:    # its socket may have been shut down
+            conn.close()
+            return
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self._idle_connections:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _settimeout(self, conn, deadline):
+        '''set the timeout of conn so that it doesn't wait beyond the
+        deadline'''
+        left = deadline.end - time.time()
+        if left <= 0 or deadline.expired:
+            raise FetchError("deadline exceeded")
+        conn.timeout = min(self._timeout, left)
+        if conn.sock:
+            conn.sock.settimeout(conn.timeout)
+
+    def _get(self, url, deadline):
+        '''GET url, return (status, location, body)'''
+        u = urlsplit(url)
+        if u.scheme not in ["http", "https"] or not u.netloc:
+            raise FetchError("unsupported url " + url)
+        path = quote(u.path or "/", url_safe)
+        if u.query:
+            path += "?" + quote(u.query, url_safe)
+        key = (u.scheme, u.netloc)
+        while True:
+            conn, reused = self._connection(key)
+            deadline.watch(conn)
+            try:
+                self._settimeout(conn, deadline)
+                conn.request("GET", path, headers = {"User-Agent": user_agent,
+                                                     "Accept": "*/*"})
+                self._settimeout(conn, deadline)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                self._settimeout(conn, deadline) # raise if it has expired
+                # the server may have closed an idle connection, retry
+                # once with a new one
+                if not reused:
+                    raise FetchError(str(e) or e.__class__.__name__)
+            except FetchError:
+                conn.close()
+                raise
+        try:
+            body = []
+            size = 0
+            while size < self._quota:
+                self._settimeout(conn, deadline)
+                data = response.read(min(1 << 16, self._quota - size))
+                if not data:
+                    break
+                body.append(data)
+                size += len(data)
+            # the end of the data may come from the shutdown of the
+            # socket by the deadline
+            self._settimeout(conn, deadline)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            self._settimeout(conn, deadline)
+            raise FetchError(str(e) or e.__class__.__name__)
+        except FetchError:
+            conn.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            self._release(key, conn, deadline)
+        else:                   # quota reached, or no keep-alive
+            deadline.watch(None)
+            conn.close()
+        return response.status, response.getheader("location"), "".join(body)
@@ -11,5 +11,5 @@ FLAGS "$@" || exit 1
 eval set -- "${FLAGS_ARGV}"
 
 # copy the utilies under prefix/bin
-echo cp build-techtc.py "${FLAGS_prefix}/bin"
-cp build-techtc.py "${FLAGS_prefix}/bin"
+echo cp build-techtc.py compression.py fetcher.py metrics.py "${FLAGS_prefix}/bin"
+cp build-techtc.py compression.py fetcher.py metrics.py "${FLAGS_prefix}/bin"
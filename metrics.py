@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Timers, counters and progress of the stages of a program
+
+"""Record the time spent in each stage of a program and count what
+it processes (bytes parsed, topics, links, documents...). The counts
+made during a stage are attributed to it, so its rates (per second)
+can be reported. A stage can be profiled with cProfile, and a live
+line on the stderr shows the progress and estimated time left of long
+stages.
+
+The functions of this module use a default Metrics object:
+
+    import metrics
+    with metrics.stage("download"):
+        ...
+        metrics.count("bytes_downloaded", size)
+        metrics.progress("download", done, total)
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# minimum number of seconds between 2 progress lines, on a terminal
+# (where the line is rewritten) or not
+progress_tty_period = 0.5
+progress_log_period = 10
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds / 60, seconds % 60)
+
+
+class Metrics:
+    '''timers and counters of the stages of a program'''
+    def __init__(self):
+        self.start = time.time()
+        self.counters = {}
+        self.stages = OrderedDict() # name -> seconds, calls, counters
+        self.profile_dir = None     # profile the stages if set
+        self._profiles = OrderedDict()
+        self._profiling = False
+        self._progress = {}         # name -> (start time, start done)
+        self._progress_time = 0
+        self._progress_line = False
+        self._lock = threading.Lock()
+
+    def count(self, name, n = 1):
+        '''add n to the counter name, can be called by any thread'''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    @contextmanager
+    def stage(self, name):
+        '''time the code run in this context as the stage name, the
+        times of several runs of the same stage are added. If
+        profile_dir is set the stage is profiled too (unless it is
+        nested in a stage already profiled).'''
+        with self._lock:
+            before = dict(self.counters)
+        profile = None
+        if self.profile_dir and not self._profiling:
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+            self._profiling = True
+            profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            if profile:
+                profile.disable()
+                self._profiling = False
+            self._end_progress()
+            with self._lock:
+                s = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0,
+                                                  "counters": {}})
+                s["seconds"] += seconds
+                s["calls"] += 1
+                for k, v in self.counters.iteritems():
+                    d = v - before.get(k, 0)
+                    if d:
+                        s["counters"][k] = s["counters"].get(k, 0) + d
+
+    def progress(self, name, done, total = None):
+        '''show that done items out of total of name have been
+        processed, with the rate and the estimated time left. On a
+        terminal the line is rewritten, otherwise a line is written
+        from time to time.'''
+        now = time.time()
+        with self._lock:
+            if name not in self._progress:
+                self._progress[name] = (now, done)
+            tty = sys.stderr.isatty()
+            period = progress_tty_period if tty else progress_log_period
+            if now - self._progress_time < period and done != total:
+                return
+            self._progress_time = now
+            start, start_done = self._progress[name]
+            rate = (done - start_done) / (now - start) if now > start else 0
+            line = "%s %d" % (name, done)
+            if total:
+                line += "/%d (%d%%)" % (total, 100 * done / total)
+            line += " %.1f/s" % rate
+            if total and rate:
+                line += " ETA " + format_duration((total - done) / rate)
+            if tty:
+                sys.stderr.write("\r" + line.ljust(79))
+                self._progress_line = True
+            else:
+                sys.stderr.write(line + "\n")
+            sys.stderr.flush()
+
+    def _end_progress(self):
+        with self._lock:
+            if self._progress_line:
+                sys.stderr.write("\n")
+                self._progress_line = False
+            self._progress = {}
+            self._progress_time = 0
+
+    def summary(self):
+        '''return the stages, with their rates, and the counters as a
+        dict'''
+        stages = OrderedDict()
+        for name, s in self.stages.iteritems():
+            stages[name] = dict(s)
+            stages[name]["rates"] = dict(
+                (k, v / s["seconds"] if s["seconds"] else 0.0)
+                for k, v in s["counters"].iteritems())
+        return OrderedDict([("seconds", time.time() - self.start),
+                            ("stages", stages),
+                            ("counters", dict(self.counters))])
+
+    def report(self, out = None):
+        '''print the time, counters and rates of each stage, on the
+        stderr by default, like the progress, so that they don't mix
+        with data written on the stdout'''
+        out = out or sys.stderr
+        summary = self.summary()
+        for name, s in summary["stages"].iteritems():
+            out.write("Stage %s: %.3f s" % (name, s["seconds"]))
+            for k in sorted(s["counters"]):
+                out.write(", %s = %d (%.1f/s)" % (k, s["counters"][k], s["rates"][k]))
+            out.write("\n")
+        out.write("Total: %.3f s\n" % summary["seconds"])
+
+    def write(self, fileName):
+        '''write the summary in fileName, in CSV (stage, name, value)
+        if its extension is .csv, in JSON otherwise'''
+        summary = self.summary()
+        with open(fileName, "w") as f:
+            if not fileName.endswith(".csv"):
+                json.dump(summary, f, indent = 2, sort_keys = True)
+                f.write("\n")
+                return
+            w = csv.writer(f)
+            w.writerow(["stage", "name", "value"])
+            w.writerow(["", "seconds", summary["seconds"]])
+            for k in sorted(summary["counters"]):
+                w.writerow(["", k, summary["counters"][k]])
+            for name, s in summary["stages"].iteritems():
+                w.writerow([name, "seconds", s["seconds"]])
+                w.writerow([name, "calls", s["calls"]])
+                for k in sorted(s["counters"]):
+                    w.writerow([name, k, s["counters"][k]])
+                    w.writerow([name, k + "/s", s["rates"][k]])
+
+    def dump_profiles(self):
+        '''write the profile of each stage in profile_dir/STAGE.prof,
+        readable with pstats'''
+        if not self._profiles:
+            return
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        for name, profile in self._profiles.iteritems():
+            profile.dump_stats(os.path.join(self.profile_dir, name + ".prof"))
+
+
+# default Metrics object, used by the functions below
+default = Metrics()
+
+count = default.count
+stage = default.stage
+progress = default.progress
+
+
+def add_options(parser):
+    '''add options --metrics-file and --profile to parser'''
+    parser.add_option("--metrics-file",
+                      help="File where to write the time, counters and rates of each stage at the end, in CSV format if its extension is .csv, JSON otherwise.")
+    parser.add_option("--profile", metavar="DIR",
+                      help="Profile each stage with cProfile, the profile of STAGE being written in DIR/STAGE.prof (only the main thread is profiled).")
+
+
+def start(options):
+    '''start recording according to the options of add_options'''
+    default.profile_dir = options.profile
+
+
+def finish(options):
+    '''report the stages, and write the metrics and the profiles
+    according to the options of add_options'''
+    default.report()
+    if options.metrics_file:
+        default.write(options.metrics_file)
+    if options.profile:
+        default.dump_profiles()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Keep only the features of datasets whose mutual information with the
+# target is above a threshold
+
+"""Filter the features (words) of datasets produced by techtc2CSV.py,
+keeping only those whose mutual information (in bits) with the target
+is above a threshold. The mutual information of each feature is
+computed from the number of rows of each class where it is 1.
+
+The datasets are read twice as streams, once to count and once to
+write the rows with the features kept, in place (through a temporary
+file renamed over the dataset) unless an output file is given.
+Supported formats are csv (header of features, target as last column)
+and svmlight (target then INDEX:VALUE, the names of the features being
+in the .vocab file next to it, rewritten as well).
+"""
+
+import os
+import tempfile
+from math import log
+from collections import Counter
+from optparse import OptionParser
+
+
+def mutualInformation(docs, classDocs, featureDocs):
+    '''mutual information in bits between a binary feature and the
+    target. docs is the number of rows, classDocs[y] the number of rows
+    of class y and featureDocs[y] the number of rows of class y where
+    the feature is 1.'''
+    n1 = sum(featureDocs.itervalues())
+    mi = 0.0
+    for y, ny in classDocs.iteritems():
+        ny1 = featureDocs.get(y, 0)
+        for nxy, nx in ((ny1, n1), (ny - ny1, docs - n1)):
+            if nxy:
+                mi += nxy * log(float(nxy) * docs / (nx * ny), 2)
+    return mi / docs if docs else 0.0
+
+
+def selectFeatures(features, classDocs, classFeatureDocs, threshold):
+    '''return the features (in the same order) whose mutual information
+    with the target is above threshold. classDocs[y] is the number of
+    rows of class y, classFeatureDocs[y][f] the number of rows of class
+    y where feature f is 1.'''
+    docs = sum(classDocs.itervalues())
+    return [f for f in features
+            if mutualInformation(docs, classDocs,
+                                 dict((y, c[f]) for y, c
+                                      in classFeatureDocs.iteritems()))
+            > threshold]
+
+
+def vocabFileName(dataFileName):
+    return os.path.splitext(dataFileName)[0] + ".vocab"
+
+
+def replaceWith(fileName, write):
+    '''write a new version of fileName with write(file) in a temporary
+    file, then rename it as fileName'''
+    d = os.path.dirname(os.path.abspath(fileName))
+    fd, tmpFileName = tempfile.mkstemp(dir = d)
+    try:
+        with os.fdopen(fd, "w") as f:
+            write(f)
+        # keep the permissions of fileName (or the default ones)
+        if os.path.exists(fileName):
+            os.chmod(tmpFileName, os.stat(fileName).st_mode & 0777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpFileName, 0666 & ~umask)
+        os.rename(tmpFileName, fileName)
+    except:
+        os.remove(tmpFileName)
+        raise
+
+
+def filterCSV(dataFileName, outputFileName, threshold):
+    '''filter the columns of a CSV dataset, return the number of
+    features (before, after)'''
+    classDocs = Counter()
+    classFeatureDocs = {}
+    with open(dataFileName) as dataFile:
+        header = dataFile.readline().rstrip("\r\n").split(",")
+        for l in dataFile:
+            cells = l.rstrip("\r\n").split(",")
+            y = cells.pop()
+            classDocs[y] += 1
+            c = classFeatureDocs.setdefault(y, Counter())
+            c.update([i for i, v in enumerate(cells) if v != "0"])
+    keep = selectFeatures(range(len(header) - 1), classDocs,
+                          classFeatureDocs, threshold) + [len(header) - 1]
+
+    def write(outputFile):
+        with open(dataFileName) as dataFile:
+            for l in dataFile:
+                eol = l[len(l.rstrip("\r\n")):]
+                cells = l[:len(l) - len(eol)].split(",")
+                outputFile.write(",".join([cells[i] for i in keep]) + eol)
+    replaceWith(outputFileName, write)
+    return len(header) - 1, len(keep) - 1
+
+
+def filterSVMlight(dataFileName, outputFileName, threshold):
+    '''filter the features of a SVMlight dataset and its vocabulary,
+    return the number of features (before, after)'''
+    with open(vocabFileName(dataFileName)) as vocabFile:
+        vocab = vocabFile.read().splitlines()
+    classDocs = Counter()
+    classFeatureDocs = {}
+    with open(dataFileName) as dataFile:
+        for l in dataFile:
+            cells = l.split()
+            if not cells:
+                continue
+            y = cells[0]
+            classDocs[y] += 1
+            c = classFeatureDocs.setdefault(y, Counter())
+            c.update([int(iv.partition(":")[0]) for iv in cells[1:]
+                      if iv.partition(":")[2] != "0"])
+    keep = selectFeatures(range(1, len(vocab) + 1), classDocs,
+                          classFeatureDocs, threshold)
+    index = dict((i, str(k + 1)) for k, i in enumerate(keep))
+
+    def write(outputFile):
+        with open(dataFileName) as dataFile:
+            for l in dataFile:
+                cells = l.split()
+                if not cells:
+                    continue
+                row = [cells[0]]
+                for iv in cells[1:]:
+                    i, _, v = iv.partition(":")
+                    k = index.get(int(i))
+                    if k:
+                        row.append(k + ":" + v)
+                outputFile.write(" ".join(row) + "\n")
+    replaceWith(outputFileName, write)
+
+    def writeVocab(vocabFile):
+        for i in keep:
+            vocabFile.write(vocab[i - 1] + "\n")
+    replaceWith(vocabFileName(outputFileName), writeVocab)
+    return len(vocab), len(keep)
+
+
+# filter of each format, by extension
+filters = {".csv": filterCSV, ".svmlight": filterSVMlight}
+
+
+def main():
+    usage = "Usage: %prog THRESHOLD DATA_FILE... [Options]\n\nDATA_FILE is a csv or svmlight file produced by techtc2CSV.py."
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--output-file", action="append", default=[],
+                      help="File where to write the filtered dataset. If several data files are given, this option is given once for each of them, in the same order. If it is not given the data files are filtered in place.")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("incorrect number of arguments. Use --help to get more information")
+
+    try:
+        threshold = float(args[0])
+    except ValueError:
+        parser.error("THRESHOLD must be a number")
+    dataFileNames = args[1:]
+
+    if options.output_file and len(options.output_file) != len(dataFileNames):
+        parser.error("the number of output files doesn't match the number of data files")
+
+    for dataFileName in dataFileNames:
+        if os.path.splitext(dataFileName)[1] not in filters:
+            parser.error(dataFileName + " is not a csv or svmlight file")
+
+    for dataFileName, outputFileName in zip(dataFileNames, options.output_file or dataFileNames):
+        ext = os.path.splitext(dataFileName)[1]
+        before, after = filters[ext](dataFileName, outputFileName, threshold)
+        print outputFileName, "has", after, "words out of", before
+
+if __name__ == "__main__":
+    main()
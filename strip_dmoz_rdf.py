@@ -1,15 +1,220 @@
 #!/usr/bin/env python
 import os
+import re
 import sys
+import shutil
+import tempfile
+import multiprocessing
 from optparse import OptionParser
+from compression import open_input, open_output, compression_ext
+
+# size of the blocks read at once
+chunk_size = 1 << 24
+
+# lines containing one of these change the state of the stripping
+# (whether we are in an ExternalPage or Alias element)
+state_re = re.compile(r"<ExternalPage|</ExternalPage>|<Alias|</Alias>")
+
+# lines containing one of these are not written
+drop_re = re.compile(r"<ExternalPage|</ExternalPage>|<Alias|</Alias>"
+                     r"|<d:Description>|<lastUpdate>|<d:Title>|<editor"
+                     r"|<altlang|<related|<newsgroup")
+
+# beginning of the top level elements, the state is known there so
+# the file can be split at these lines
+shard_re = re.compile(r"\n(?:<Topic|<ExternalPage)")
+
+
+def strip_buffer(buf, state, write):
+    '''strip buf, a string of complete lines, and write the lines to
+    keep with write. state is the pair (externalPage, alias) at the
+    beginning of buf, return the state at the end of buf. Only the
+    lines matching drop_re (or state_re inside an element to remove)
+    are looked at, the lines in between are written (or dropped) in
+    bulk, and so are whole ExternalPage elements most of the time.'''
+    externalPage, alias = state
+    pos = 0
+    n = len(buf)
+    while pos < n:
+        if externalPage or alias:
+            # all the lines until the next state change are dropped
+            m = state_re.search(buf, pos)
+            if not m:
+                break
+            start = buf.rfind("\n", pos, m.start()) + 1 or pos
+        else:
+            # all the lines until the next line to drop are written
+            m = drop_re.search(buf, pos)
+            if not m:
+                write(buf[pos:])
+                break
+            start = buf.rfind("\n", pos, m.start()) + 1 or pos
+            if start > pos:
+                write(buf[pos:start])
+            if m.group() == "<ExternalPage":
+                # most of the time the whole element can be skipped at
+                # once, that is when no other line in it changes the
+                # state, and so can the ExternalPage elements following
+                # it
+                p = start
+                while True:
+                    o = buf.find("<ExternalPage", p)
+                    c = buf.find("</ExternalPage>", o)
+                    if o < 0 or c < 0 or buf.find("\n", o, c) < 0 or \
+                       state_re.search(buf, o + 13, c):
+                        break
+                    e = buf.find("\n", c) + 1 or n
+                    if buf.find("<ExternalPage", c, e) >= 0 or \
+                       (o > p and buf.find("\n", p, o) >= 0):
+                        break
+                    p = e
+                    if not buf.startswith("<ExternalPage", p):
+                        break
+                if p > start:
+                    pos = p
+                    continue
+        end = buf.find("\n", m.end())
+        end = n if end < 0 else end + 1
+        l = buf[start:end]
+        if "<ExternalPage" in l:
+            externalPage = True
+        elif "</ExternalPage>" in l:
+            externalPage = False
+        elif "<Alias" in l:
+            alias = True
+        elif "</Alias>" in l:
+            alias = False
+        pos = end
+    return externalPage, alias
+
+
+def strip_stream(XMLFile, outputFile, size = None, state = (False, False)):
+    '''strip XMLFile, reading it by blocks, and write the result in
+    outputFile. If size is given only the size next bytes are read.
+    state is the state at the beginning, return the state at the
+    end.'''
+    rest = ""
+    while size is None or size > 0:
+        data = XMLFile.read(chunk_size if size is None else min(chunk_size, size))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        data = rest + data
+        cut = data.rfind("\n") + 1
+        rest = data[cut:]
+        state = strip_buffer(data[:cut], state, outputFile.write)
+    if rest:
+        state = strip_buffer(rest, state, outputFile.write)
+    return state
+
+
+def shard_offsets(XMLFileName, n):
+    '''return the offsets where to split XMLFileName in up to n shards.
+    Each shard but the first begins at a line opening a Topic or an
+    ExternalPage element.'''
+    size = os.path.getsize(XMLFileName)
+    offsets = [0]
+    with open(XMLFileName, "rb") as f:
+        for k in range(1, n):
+            pos = max(size * k / n, offsets[-1] + 1) - 1
+            f.seek(pos)
+            data = ""
+            while True:
+                block = f.read(1 << 20)
+                if not block:
+                    break
+                data += block
+                m = shard_re.search(data)
+                if m:
+                    offsets.append(pos + m.start() + 1)
+                    break
+                data = data[-len("\n<ExternalPage"):]
+                pos = f.tell() - len(data)
+            if not block:
+                break
+    return offsets + [size]
+
+
+def strip_shard(args, state = (False, False)):
+    '''strip the bytes from start to end of XMLFileName into
+    shardFileName (the whole file if start is None), starting with
+    state. Return the state at the end.'''
+    XMLFileName, start, end, shardFileName = args
+    with open(shardFileName, "wb") as shardFile:
+        if start is None:
+            with open_input(XMLFileName) as XMLFile:
+                return strip_stream(XMLFile, shardFile, None, state)
+        else:
+            with open(XMLFileName, "rb") as XMLFile:
+                XMLFile.seek(start)
+                return strip_stream(XMLFile, shardFile, end - start, state)
+
+
+def stripped_file_name(XMLFileName):
+    '''insert _stripped before the extensions of XMLFileName, like
+    structure.rdf.u8 -> structure_stripped.rdf.u8'''
+    d, b = os.path.split(XMLFileName)
+    name, dot, ext = b.partition(".")
+    return os.path.join(d, name + "_stripped" + dot + ext)
+
+
+def strip_XML_files(XMLFileNames, outputFileNames, jobs):
+    '''strip all XMLFileNames, each one into the file of the same
+    index in outputFileNames (the stdout if it is empty). The
+    uncompressed files are split in shards, all shards of all files
+    being processed by jobs processes, then joined in order.'''
+    tmpDir = tempfile.mkdtemp(
+        dir = os.path.dirname(os.path.abspath(outputFileNames[0])) if outputFileNames[0] else None)
+    try:
+        tasks = []
+        shards = []             # shards of each file
+        for XMLFileName in XMLFileNames:
+            if compression_ext(XMLFileName) or jobs == 1:
+                offsets = [None, None]
+            else:
+                offsets = shard_offsets(XMLFileName, jobs)
+            shards.append([])
+            for start, end in zip(offsets, offsets[1:]):
+                shardFileName = os.path.join(tmpDir, str(len(tasks)))
+                tasks.append((XMLFileName, start, end, shardFileName))
+                shards[-1].append(shardFileName)
+        if jobs == 1:
+            states = map(strip_shard, tasks)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            states = pool.map(strip_shard, tasks, 1)
+            pool.close()
+        k = 0
+        for outputFileName, shardFileNames in zip(outputFileNames, shards):
+            outputFile = open_output(outputFileName) if outputFileName else sys.stdout
+            state = (False, False)
+            for shardFileName in shardFileNames:
+                # a shard has been stripped assuming it starts outside
+                # of any element to remove, which is always the case
+                # unless the file is ill-formed, then strip it again
+                if state != (False, False):
+                    states[k] = strip_shard(tasks[k], state)
+                state = states[k]
+                k += 1
+                with open(shardFileName, "rb") as shardFile:
+                    shutil.copyfileobj(shardFile, outputFile, chunk_size)
+                os.remove(shardFileName)
+            if outputFileName:
+                outputFile.close()
+            else:
+                outputFile.flush()
+    finally:
+        shutil.rmtree(tmpDir)
+
 
 def strip_XML(XMLFileName, options):
     if options.output_file:
-        outputFile = open(options.output_file, "w")
+        outputFile = open_output(options.output_file)
     else:
         outputFile = sys.stdout
 
-    with open(XMLFileName) as XMLFile:
+    with open_input(XMLFileName) as XMLFile:
         externalPage = False
         alias = False
         isWritable = lambda l: (not externalPage
@@ -33,20 +238,40 @@ def strip_XML(XMLFileName, options):
             elif isWritable(l):
                 outputFile.write(l)
 
+    if options.output_file:
+        outputFile.close()
+
 
 def main():
-    usage = "Usage: %prog XML_FILE [Options]"
+    usage = "Usage: %prog XML_FILE... [Options]\n\nXML_FILE can be compressed (.gz, .bz2 or .xz)."
     parser = OptionParser(usage)
-    parser.add_option("-o", "--output-file", default="",
-                      help="File where to write the XML file once stripped. If no file is provided it writes the result on the stdout.")
+    parser.add_option("-o", "--output-file", action="append", default=[],
+                      help="File where to write the XML file once stripped, compressed if its extension is .gz, .bz2 or .xz. If no file is provided it writes the result on the stdout. If several XML files are given, this option is given once for each of them, in the same order, or not at all, in which case they are written in XML_FILE with _stripped inserted before the extension (e.g. structure_stripped.rdf.u8).")
+    parser.add_option("-j", "--jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="Number of processes stripping the XML files. Uncompressed files are split in that many shards. [default: number of CPUs]")
+    parser.add_option("-l", "--line-by-line", action="store_true",
+                      help="Use the former line by line stripping, much slower. Only one XML file can be given then.")
     (options, args) = parser.parse_args()
 
-    if len(args) != 1:
+    if len(args) < 1:
         parser.error("incorrect number of arguments. Use --help to get more information")
 
-    XMLFileName = args[0]
-        
-    strip_XML(XMLFileName, options)
+    if options.output_file and len(options.output_file) != len(args):
+        parser.error("the number of output files doesn't match the number of XML files")
+
+    if options.line_by_line:
+        if len(args) != 1:
+            parser.error("option -l accepts only one XML file")
+        options.output_file = options.output_file[0] if options.output_file else ""
+        strip_XML(args[0], options)
+    elif options.output_file:
+        strip_XML_files(args, options.output_file, max(1, options.jobs))
+    elif len(args) == 1:
+        strip_XML_files(args, [""], max(1, options.jobs))
+    else:
+        strip_XML_files(args, map(stripped_file_name, args),
+                        max(1, options.jobs))
 
 if __name__ == "__main__":
     main()
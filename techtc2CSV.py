@@ -18,9 +18,15 @@ Some preprocessing:
 
 import sys
 import os
+import re
+import string
+import multiprocessing
 import Stemmer
-from collections import Counter
+from array import array
+from itertools import chain, imap, izip
 from optparse import OptionParser
+from mi_filter import selectFeatures
+import metrics
 
 # 1) Stop words are removed
 # Google's list of stop words
@@ -34,124 +40,397 @@ def check_file(fileTitle,fileName):
         sys.stderr.write(os.linesep)
         sys.exit()
 
-def preprocessWord(word):
-    # 1) All punctuation characters are removed from tokens
-    word.strip(",.?:;!\"")
-    # 2) Everything is converted in lower case
-    word=word.lower()
-    # # 3) Stop words are ignored
-    # if word in stop_words:
-    #     return ""
-    # 4) dash characters between words are removed (brain-washed => brainwashed)
-    word.replace("-", "")
-    # 5) numbers and mixed alphanumaric strings (e.g. Win2K) are ignored
-    if not word.isalpha():
-        return ""
-    # 6) Stemming is performed using PyStemmer
-    global stemmer
-    word = stemmer.stemWord(word)
-    return word
-
-# collect and preprocess (filter and stem) all words of the line
-def preprocessLine(line):
-    words = set()
-    for w in line.split():
-        for subw in w.split("'"):    # split ' (e.g. "you're")
-            word = preprocessWord(subw)
-            if word:
-                words.add(word)
-    return words
-    
-# read a dmoz_doc and return the set of words that it contains.
-# On the way it filters and stem the words
-def DocWords(doc):
-    words = set()
-    for l in doc:
-        words |= preprocessLine(l)
-    return words
-
-# Return a list of set of words, each element of the list corresponds
-# to a document and the set of words whether it appears or not in the
-# document
-def FListWords(File):
-    lines = File.readlines()
-    start_doc = False
-    res = []                    # list of word set
-    for l in lines:
+# punctuation characters, but ' which splits words (e.g. "you're")
+punctuation = string.punctuation.replace("'", "")
+
+# 4) dash characters between words
+dash_re = re.compile(r"(?<=[a-z])-(?=[a-z])")
+
+# a token, separated by spaces or ', made of letters only once the
+# punctuation at its ends is removed, the letters being captured
+token_re = re.compile(r"(?<![^\s'])[%s]*([a-z]+)[%s]*(?![^\s'])"
+                      % ((re.escape(punctuation),) * 2))
+
+# stem of each word met so far, shared by all documents
+stems = {}
+
+# integer ids of the words (stems), a document is the sorted array of
+# the ids of its words
+class Vocabulary:
+    def __init__(self):
+        self.ids = {}           # word -> id
+        self.words = []         # id -> word
+
+    def __len__(self):
+        return len(self.words)
+
+    # return the ids of words, assigning new ids to the new words
+    def table(self, words):
+        ids = []
+        for w in words:
+            i = self.ids.get(w)
+            if i is None:
+                i = self.ids[w] = len(self.words)
+                self.words.append(w)
+            ids.append(i)
+        return ids
+
+    # return the document made of the set of words
+    def doc(self, words):
+        return array("I", sorted(self.table(words)))
+
+    # return the document of this vocabulary of the document doc of
+    # the vocabulary of which words are the words
+    def translate(self, doc, table):
+        return array("I", sorted([table[i] for i in doc]))
+
+# vocabulary of the documents converted
+vocabulary = Vocabulary()
+
+# return the set of words (filtered but not stemmed) of text, steps 1,
+# 2, 4 and 5 of the preprocessing being performed on the whole text at
+# once
+def tokenize(text):
+    return set(token_re.findall(dash_re.sub("", text.lower())))
+
+# return the set of stems of words. The words never met before are
+# stemmed together and memorized
+def stemWords(words):
+    new = [w for w in words if w not in stems]
+    if new:
+        stems.update(zip(new, stemmer.stemWords(new)))
+    return set(stems[w] for w in words)
+
+# read a dmoz_doc and return the ids in vocab (vocabulary by default)
+# of the words that it contains. On the way it filters and stem the
+# words
+def DocWords(doc, vocab=None):
+    if vocab is None:
+        vocab = vocabulary
+    return vocab.doc(stemWords(tokenize("".join(doc))))
+
+# Generate the word ids of each document of File, reading it line by
+# line so only one document is in memory at a time
+def iterDocWords(File, vocab=None):
+    doc = None
+    for l in File:
         if "<dmoz_doc>" in l:
-            start_doc = True
             doc = []
-        elif "</dmoz_doc>" in l:
-            start_doc = False
-            res.append(DocWords(doc))
-        if start_doc:
+        if doc is not None:
             doc.append(l)
-    return res
+            if "</dmoz_doc>" in l:
+                yield DocWords(doc, vocab)
+                doc = None
+
+# Return a list of array of word ids, each element of the list
+# corresponds to a document and the ids of the words appearing in the
+# document
+def FListWords(File, vocab=None):
+    return list(iterDocWords(File, vocab))
 
-# gather all the words from list of set of words. Words must appear at
-# least in 2 documents to be included in the result
+# return the number of documents of listWS where each word id appears,
+# indexed by word id
+def documentFrequencies(listWS):
+    counts = [0] * len(vocabulary)
+    for i in chain.from_iterable(listWS):
+        counts[i] += 1
+    return counts
+
+# gather all the word ids from list of arrays of word ids. Words must
+# appear at least in 3 documents to be included in the result
 def gatherWords(listWS):
-    mw = []                     # list of all words including duplicates
-    for ws in listWS:
-        mw += list(ws)
-    cw = Counter(mw)            # multiset of words (using Counter)
     # 7) Words appearing in less than 3 documents are removed
-    words = set([w for w in cw.keys() if cw[w] > 2])
-    return words
-
-# take dom of positive and negative and write the CSV table on the
-# stdout
-def convertF2CSV(posFile, negFile, targetVar, outputFileName):
-    # list of all positive doc with all present words
-    plws = FListWords(posFile)
-    # list of all negative doc with all present words
-    nlws = FListWords(negFile)
-    # list of all words
-    words = gatherWords(plws+nlws)
-
-    print outputFileName, "has", len(words), "words"
-    
-    # write the header of the CSV, i.e. list of words, and targetVar
-    # as last argument
-    outputFile = open(outputFileName, "w") if outputFileName else sys.stdout
-    for w in words:
-        outputFile.write(w+",")
-    outputFile.write(targetVar)
-    outputFile.write(os.linesep)
-    # write alternation of positive and negative (so that truncating
-    # the data will remain unbiased)
+    return [i for i, c in enumerate(documentFrequencies(listWS)) if c > 2]
+
+# output formats, csv is a dense table, the others are sparse (only
+# the 1s are written) with the words in a separate vocabulary file
+formats = ["csv", "svmlight", "npz", "mtx"]
+
+# name of the file listing the words (one per line, in the order of
+# the columns) next to outputFileName
+def vocabFileName(outputFileName):
+    return os.path.splitext(outputFileName)[0] + ".vocab"
+
+# name of the file listing the targets (one per line, in the order of
+# the rows) next to outputFileName
+def labelsFileName(outputFileName):
+    return os.path.splitext(outputFileName)[0] + ".labels"
+
+# alternation of positive and negative (so that truncating the data
+# will remain unbiased), return a list of (word ids, target)
+def interleaveDocs(plws, nlws):
+    rows = []
     for i in range(max(len(plws), len(nlws))):
         if i < len(plws):
-            for w in words:
-                outputFile.write(("1" if w in plws[i] else "0")+",")
-            outputFile.write("1")           # because it is positive
-            outputFile.write(os.linesep)
+            rows.append((plws[i], 1))   # because it is positive
         if i < len(nlws):
-            for w in words:
-                outputFile.write(("1" if w in nlws[i] else "0")+",")
-            outputFile.write("0")           # because it is negative
-            outputFile.write(os.linesep)
+            rows.append((nlws[i], 0))   # because it is negative
+    return rows
+
+# return for each row the sorted list of the column indexes of its
+# words, words being the word ids of the columns
+def sparseRows(rows, words):
+    index = [None] * len(vocabulary)
+    for c, w in enumerate(words):
+        index[w] = c
+    return [sorted([c for c in map(index.__getitem__, ws) if c is not None])
+            for ws, _ in rows]
+
+def writeVocab(words, outputFileName):
+    with open(vocabFileName(outputFileName), "w") as vocabFile:
+        for w in words:
+            vocabFile.write(vocabulary.words[w] + "\n")
+
+def writeLabels(rows, targetVar, outputFileName):
+    with open(labelsFileName(outputFileName), "w") as labelsFile:
+        labelsFile.write(targetVar + "\n")
+        for _, t in rows:
+            labelsFile.write("%d\n" % t)
+
+# write the CSV, the header is the list of words, and targetVar as
+# last argument. Each row is built from a row of 0s where the indexes
+# of its words are set to 1 and written at once
+def writeCSV(rows, words, targetVar, outputFile):
+    outputFile.write(",".join([vocabulary.words[w] for w in words]
+                              + [targetVar]) + os.linesep)
+    zeros = ["0"] * len(words)
+    for (_, t), idx in zip(rows, sparseRows(rows, words)):
+        cells = zeros[:]
+        for i in idx:
+            cells[i] = "1"
+        cells.append(str(t))
+        outputFile.write(",".join(cells) + os.linesep)
+
+# write in SVMlight format, "target index:1 ..." with indexes starting
+# at 1
+def writeSVMlight(rows, words, outputFile):
+    for (_, t), idx in zip(rows, sparseRows(rows, words)):
+        outputFile.write(" ".join([str(t)] + ["%d:1" % (i + 1) for i in idx])
+                         + "\n")
+
+# write in Matrix Market coordinate format, indexes starting at 1
+def writeMTX(rows, words, outputFile):
+    srows = sparseRows(rows, words)
+    outputFile.write("%%MatrixMarket matrix coordinate integer general\n")
+    outputFile.write("%d %d %d\n" % (len(rows), len(words),
+                                      sum(len(idx) for idx in srows)))
+    for r, idx in enumerate(srows):
+        if idx:
+            outputFile.write("".join(["%d %d 1\n" % (r + 1, i + 1)
+                                      for i in idx]))
+
+# write a CSR matrix in numpy .npz format, readable with
+# scipy.sparse.load_npz, with the targets in the labels array
+def writeNPZ(rows, words, outputFileName):
+    import numpy                # only needed for this format
+    srows = sparseRows(rows, words)
+    indptr = numpy.zeros(len(srows) + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum([len(idx) for idx in srows])
+    indices = numpy.fromiter(chain.from_iterable(srows), dtype=numpy.int32,
+                             count=int(indptr[-1]))
+    with open(outputFileName, "wb") as outputFile:
+        numpy.savez_compressed(outputFile, format="csr",
+                               shape=numpy.array([len(rows), len(words)]),
+                               data=numpy.ones(len(indices), dtype=numpy.int8),
+                               indices=indices, indptr=indptr,
+                               labels=numpy.array([t for _, t in rows],
+                                                  dtype=numpy.int8))
+
+# write the table of the documents plws (positive) and nlws (negative)
+# in outputFileName (on the stdout if empty) in the given format
+def writeTable(plws, nlws, targetVar, outputFileName, format="csv",
+               miThreshold=None):
+    # list of all word ids, sorted by word so that the columns are
+    # always in the same order
+    words = sorted(gatherWords(plws+nlws), key=vocabulary.words.__getitem__)
+    # only keep the words whose mutual information with the target is
+    # above miThreshold
+    if miThreshold is not None:
+        words = selectFeatures(words, {1: len(plws), 0: len(nlws)},
+                               {1: documentFrequencies(plws),
+                                0: documentFrequencies(nlws)},
+                               miThreshold)
+
+    if outputFileName:          # not on the stdout with the data
+        print outputFileName, "has", len(words), "words"
+
+    rows = interleaveDocs(plws, nlws)
+    if format == "npz":
+        writeNPZ(rows, words, outputFileName)
+    else:
+        outputFile = open(outputFileName, "w") if outputFileName else sys.stdout
+        if format == "csv":
+            writeCSV(rows, words, targetVar, outputFile)
+        elif format == "svmlight":
+            writeSVMlight(rows, words, outputFile)
+        else:
+            writeMTX(rows, words, outputFile)
+        if outputFileName:
+            outputFile.close()
+    if format != "csv":
+        writeVocab(words, outputFileName)
+    if format == "mtx":
+        writeLabels(rows, targetVar, outputFileName)
+    return len(words)
+
+# take dom of positive and negative and write the table in
+# outputFileName (on the stdout if empty) in the given format
+def convertF2CSV(posFile, negFile, targetVar, outputFileName, format="csv",
+                 miThreshold=None):
+    with metrics.stage("tokenize"):
+        # list of all positive doc with all present words
+        plws = FListWords(posFile)
+        # list of all negative doc with all present words
+        nlws = FListWords(negFile)
+        metrics.count("docs", len(plws) + len(nlws))
+    with metrics.stage("write"):
+        metrics.count("words", writeTable(plws, nlws, targetVar,
+                                          outputFileName, format, miThreshold))
+        metrics.count("datasets")
 
 # take file names of positive and negative and write the CSV table on
 # the stdout
-def convertFN2CSV(posFileName, negFileName, targetVar, outputFileName):
+def convertFN2CSV(posFileName, negFileName, targetVar, outputFileName,
+                  format="csv", miThreshold=None):
     check_file("Positive XML file", posFileName)
     check_file("Negative XML file", negFileName)
     posFile = open(posFileName)
     negFile = open(negFileName)
-    convertF2CSV(posFile, negFile, targetVar, outputFileName)
-    
+    metrics.count("input_bytes", os.path.getsize(posFileName)
+                  + os.path.getsize(negFileName))
+    convertF2CSV(posFile, negFile, targetVar, outputFileName, format,
+                 miThreshold)
+
+# Exp_<positive topic id>_<negative topic id>
+dataset_re = re.compile(r"^Exp_(\d+)_(\d+)$")
+
+# return the list of (dataset directory, positive topic, negative
+# topic) of all datasets of the collection collectionDir. A topic is
+# identified by its id and the size of its file, as the text files of
+# the same topic in different datasets are copies of the same file, or
+# by its file name if the directory is not named after the ids.
+def collectionDatasets(collectionDir):
+    datasets = []
+    for root, dirs, files in os.walk(collectionDir):
+        dirs.sort()
+        for d in dirs:
+            if not d.startswith("Exp_"):
+                continue
+            dsd = os.path.join(root, d)
+            posFileName = os.path.join(dsd, "all_pos.txt")
+            negFileName = os.path.join(dsd, "all_neg.txt")
+            if not (os.path.exists(posFileName) and os.path.exists(negFileName)):
+                sys.stderr.write("warning: " + dsd + " ignored, all_pos.txt or all_neg.txt is missing" + os.linesep)
+                continue
+            m = dataset_re.match(d)
+            if m:
+                pos = (m.group(1), os.path.getsize(posFileName))
+                neg = (m.group(2), os.path.getsize(negFileName))
+            else:
+                pos, neg = posFileName, negFileName
+            datasets.append((dsd, (pos, posFileName), (neg, negFileName)))
+    return datasets
+
+# return the words of a topic file and the list of the word ids of
+# each document, in a vocabulary of its own (so that the ids can be
+# assigned in the collection vocabulary by the parent process)
+def topicWords(fileName):
+    vocab = Vocabulary()
+    with open(fileName) as File:
+        return vocab.words, FListWords(File, vocab)
+
+# lists of the word ids of the documents of each topic of the
+# collection being converted, by topic, set before the pool writing
+# the datasets is created so that the processes inherit it (as well as
+# the vocabulary)
+collection_words = {}
+
+# write a dataset, return its number of words
+def writeDataset(args):
+    dsd, pos, neg, targetVar, outputName, format, miThreshold = args
+    return writeTable(collection_words[pos], collection_words[neg],
+                      targetVar, os.path.join(dsd, outputName), format,
+                      miThreshold)
+
+# write the table of every dataset of the collection collectionDir in
+# outputName in its directory. Each topic is tokenized only once
+# whatever the number of datasets it belongs to, then the tables are
+# written from the words of the topics, by jobs processes.
+def convertCollection(collectionDir, targetVar, outputName, format, jobs,
+                      miThreshold=None):
+    datasets = collectionDatasets(collectionDir)
+    topicFileNames = {}
+    for _, (pos, posFileName), (neg, negFileName) in datasets:
+        topicFileNames.setdefault(pos, posFileName)
+        topicFileNames.setdefault(neg, negFileName)
+    topics = sorted(topicFileNames)
+    print "Tokenize", len(topics), "topics of", len(datasets), "datasets"
+    fileNames = [topicFileNames[t] for t in topics]
+    with metrics.stage("tokenize"):
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        words = (pool.imap if pool else imap)(topicWords, fileNames)
+        for k, (t, fileName, (topicVocab, docs)) in \
+                enumerate(izip(topics, fileNames, words)):
+            table = vocabulary.table(topicVocab)
+            collection_words[t] = [vocabulary.translate(d, table) for d in docs]
+            metrics.count("input_bytes", os.path.getsize(fileName))
+            metrics.count("docs", len(docs))
+            metrics.progress("tokenize", k + 1, len(topics))
+        if pool:
+            pool.close()
+            pool.join()
+    tasks = [(dsd, pos, neg, targetVar, outputName, format, miThreshold)
+             for dsd, (pos, _), (neg, _) in datasets]
+    with metrics.stage("write"):
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        for k, n in enumerate((pool.imap if pool else imap)(writeDataset, tasks)):
+            metrics.count("datasets")
+            metrics.count("words", n)
+            metrics.progress("write", k + 1, len(tasks))
+        if pool:
+            pool.close()
+            pool.join()
+
 def main():
-    usage = "usage: %prog POSITIVE_FILE NEGATIVE_FILE TARGET_VAR_NAME [-o OUTPUT_FILE]"
+    usage = "usage: %prog POSITIVE_FILE NEGATIVE_FILE TARGET_VAR_NAME [-o OUTPUT_FILE] [-f FORMAT]\n       %prog --collection TECHTC_DIR [TARGET_VAR_NAME] [-o OUTPUT_FILE] [-f FORMAT] [-j JOBS]"
     parser = OptionParser(usage)
     parser.add_option("-o", "--output-file",
                       dest="outputFile",
-                      help="File where to output the result. If not specified the result is printed on stdout.")
+                      help="File where to output the result. If not specified the result is printed on stdout. With --collection it is the name of the file written in each dataset directory [default: data.FORMAT].")
+    parser.add_option("-f", "--format", type="choice", choices=formats,
+                      default="csv",
+                      help="Format of the output, among " + ", ".join(formats) + ". csv is a dense table with the words as header and the target as last column. The other formats are sparse and require -o, the words are written in OUTPUT_FILE with the extension replaced by .vocab, one per line in the order of the columns. svmlight writes one row per line as TARGET INDEX:1 ..., with indexes starting at 1. mtx writes a Matrix Market coordinate matrix, with the targets in OUTPUT_FILE with the extension replaced by .labels. npz writes a CSR matrix loadable with scipy.sparse.load_npz, with the targets in its labels array, and requires numpy. [default: %default]")
+    parser.add_option("-c", "--collection",
+                      help="Convert all datasets (Exp_* directories containing all_pos.txt and all_neg.txt) under the directory COLLECTION, as created by build-techtc.py. The text of each topic is tokenized only once even if it belongs to several datasets. TARGET_VAR_NAME is then optional [default: __target__].")
+    parser.add_option("-j", "--jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="Number of processes converting the datasets with --collection. [default: number of CPUs]")
+    parser.add_option("-m", "--mi-threshold", type="float",
+                      help="Only keep the words whose mutual information (in bits) with the target is above MI_THRESHOLD.")
+    metrics.add_options(parser)
     (options, args) = parser.parse_args()
 
+    metrics.start(options)
+
+    if options.collection:
+        if len(args) > 1:
+            parser.error("incorrect number of arguments. Use --help to get more information")
+        if not os.path.isdir(options.collection):
+            parser.error("collection directory " + options.collection + " not found")
+        convertCollection(options.collection,
+                          args[0] if args else "__target__",
+                          options.outputFile or "data." + options.format,
+                          options.format, max(1, options.jobs),
+                          options.mi_threshold)
+        metrics.finish(options)
+        return
+
     if len(args) != 3:
         parser.error("incorrect number of arguments. Use --help to get more information")
 
+    if options.format != "csv" and not options.outputFile:
+        parser.error("option -f %s requires -o" % options.format)
+
     posFN = args[0]
     negFN = args[1]
     targetVar = args[2]
@@ -162,8 +441,9 @@ def main():
     # print "target = "+targetVar
     # print "outputFN = "+options.outputFile
 
-    convertFN2CSV(posFN, negFN, targetVar, options.outputFile)
+    convertFN2CSV(posFN, negFN, targetVar, options.outputFile, options.format,
+                  options.mi_threshold)
+    metrics.finish(options)
 
 if __name__ == '__main__':
     main()
-    
@@ -7,12 +7,17 @@ if [ -z "$1" ]; then
     echo "preprocess the text files and write in each directory a CSV file where"
     echo "each row corresponds to a document, columns correspond to words"
     echo "(filtered and stemmed) and the last column correspond to the result (1"
-    echo "if it is the first category, 0 if it is in the second category)"
+    echo "if it is the first category, 0 if it is in the second category)."
+    echo "FORMAT is csv (the default), svmlight, npz or mtx, the sparse formats"
+    echo "are written in data.FORMAT with the words in data.vocab (see"
+    echo "techtc2CSV.py --help)"
 
-    echo "Usage: $0 TECHTC_DIR"
+    echo "Usage: $0 TECHTC_DIR [FORMAT]"
     exit 1
 fi
 
+FORMAT=${2:-csv}
+
 TECHTC_DIR=$(readlink -f $1) # get the absolute path, no matter what
 
 DIRECTORY=$(cd `dirname "$0"` && pwd)
@@ -24,6 +29,7 @@ DIRECTORY=$(cd `dirname "$0"` && pwd)
 # convert all_pos.txt and all_neg.txt in each directory into a CSV
 # file where each feature is a word appearance (whether it appears in
 # the text or not) and the target feature is whether the document
-# belongs to the first category
-echo "Convert all pos and neg text files into data.csv"
-find "${TECHTC_DIR}" -name "Exp_*" -type d | parallel "${DIRECTORY}/techtc2CSV.py" {}"/all_pos.txt" {}"/all_neg.txt" "__target__" -o {}"/data.csv"
+# belongs to the first category. The text of each topic is tokenized
+# once for all the datasets it belongs to, using all CPUs
+echo "Convert all pos and neg text files into data.${FORMAT}"
+"${DIRECTORY}/techtc2CSV.py" --collection "${TECHTC_DIR}" "__target__" -f "${FORMAT}"